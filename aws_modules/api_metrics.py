@@ -0,0 +1,193 @@
+import math
+import os
+import threading
+import time
+
+from aws_modules.aws_session import get_session
+from aws_modules.concurrency import THROTTLE_CODES
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+# per-operation call counts, latency, retries, throttles and bytes received,
+# collected from botocore events on the shared session:
+#   python main.py --metrics --metrics-file /var/lib/node_exporter/cis_checks.prom
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+
+
+def error_code(parsed):
+    return (parsed or {}).get('Error', {}).get('Code')
+
+
+class OperationStats:
+    __slots__ = ('calls', 'errors', 'retries', 'throttles', 'received_bytes', 'seconds', 'max_seconds', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.received_bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds):
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.buckets[index] += 1
+                break
+
+    # upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        rank = q * self.calls
+        seen = 0
+
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(upper_bound, self.max_seconds)
+
+        return self.max_seconds
+
+
+class ApiMetrics:
+    def __init__(self):
+        # (service, operation) -> OperationStats
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    # clients copy the session's handlers when they are created, so this
+    # has to run before the first client is made
+    def register(self, session=None):
+        session = session or get_session()
+        # first, so the clock starts before a stubbing handler answers the call
+        session.events.register_first('before-call.*.*', self.start_call)
+        session.events.register('needs-retry.*.*', self.count_attempt)
+        session.events.register('after-call.*.*', self.end_call)
+        return session
+
+    def start_call(self, context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    # needs-retry: fires after every HTTP attempt, including the last one
+    def count_attempt(self, request_dict, response=None, **kwargs):
+        context = request_dict['context']
+        throttled = response is not None and error_code(response[1]) in THROTTLE_CODES
+        context['metrics_throttles'] = context.get('metrics_throttles', 0) + throttled
+
+    def end_call(self, http_response, parsed, model, context, **kwargs):
+        seconds = time.perf_counter() - context.get('metrics_started', time.perf_counter())
+        code = error_code(parsed)
+        # stubbed calls never reach needs-retry, only their answer is known
+        throttles = context.get('metrics_throttles', int(code in THROTTLE_CODES))
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+        received_bytes = 0
+        if http_response.raw is not None and not model.has_streaming_output:
+            received_bytes = len(http_response.content)
+
+        key = (model.service_model.service_name, model.name)
+
+        with self._lock:
+            stats = self.operations.get(key)
+            if stats is None:
+                stats = self.operations[key] = OperationStats()
+
+            stats.calls += 1
+            stats.errors += http_response.status_code >= 300
+            stats.retries += retries
+            stats.throttles += throttles
+            stats.received_bytes += received_bytes
+            stats.observe(seconds)
+
+    def table(self):
+        lines = [
+            f"{'operation':40}{'calls':>8}{'errors':>8}{'retries':>9}{'throttles':>11}"
+            f"{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}{'KiB':>10}{'total s':>10}"
+        ]
+
+        with self._lock:
+            # slowest operations in total first, that is where the run went
+            ranked = sorted(self.operations.items(), key=lambda item: item[1].seconds, reverse=True)
+
+            for (service, operation), stats in ranked:
+                lines.append(
+                    f"{service + '.' + operation:40}{stats.calls:>8}{stats.errors:>8}{stats.retries:>9}"
+                    f"{stats.throttles:>11}{stats.seconds / stats.calls * 1000:>10.1f}"
+                    f"{stats.quantile(0.95) * 1000:>10.1f}{stats.max_seconds * 1000:>10.1f}"
+                    f"{stats.received_bytes / 1024:>10.1f}{stats.seconds:>10.2f}")
+
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        counters = (
+            ('aws_api_calls_total', 'AWS API calls made', 'calls'),
+            ('aws_api_errors_total', 'AWS API calls answered with an error', 'errors'),
+            ('aws_api_retries_total', 'retries botocore made before the final answer', 'retries'),
+            ('aws_api_throttles_total', 'attempts answered with a throttling error', 'throttles'),
+            ('aws_api_received_bytes_total', 'response body bytes received', 'received_bytes'),
+        )
+        lines = []
+
+        with self._lock:
+            operations = sorted(self.operations.items())
+
+            for name, help_text, field in counters:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for (service, operation), stats in operations:
+                    lines.append(f'{name}{{service="{service}",operation="{operation}"}} {getattr(stats, field)}')
+
+            name = 'aws_api_call_duration_seconds'
+            lines.append(f"# HELP {name} AWS API call latency, retries included")
+            lines.append(f"# TYPE {name} histogram")
+            for (service, operation), stats in operations:
+                labels = f'service="{service}",operation="{operation}"'
+                cumulative = 0
+
+                for upper_bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    le = '+Inf' if upper_bound == math.inf else upper_bound
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+
+                lines.append(f'{name}_sum{{{labels}}} {stats.seconds}')
+                lines.append(f'{name}_count{{{labels}}} {stats.calls}')
+
+        return '\n'.join(lines) + '\n'
+
+    # written aside and renamed, so a scraper never reads half a file
+    def write_prometheus(self, path):
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus())
+
+        os.replace(temp_path, path)
+        LOGGER.info(f"API metrics written to {path}")
+
+
+def start_metrics(session=None):
+    metrics = ApiMetrics()
+    metrics.register(session)
+    return metrics
+
+
+def add_metrics_args(parser):
+    parser.add_argument('--metrics', action='store_true',
+                        help='print per-operation AWS API call metrics at the end of the run')
+    parser.add_argument('--metrics-file', default=None, metavar='PATH',
+                        help='also write the metrics to PATH in Prometheus text format')
+
+
+def report_metrics(metrics, path=None):
+    print(metrics.table())
+
+    if path:
+        metrics.write_prometheus(path)
@@ -0,0 +1,96 @@
+import boto3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session as get_botocore_session
+
+from aws_modules.aws_regions import check_all_regions, check_region
+from aws_modules.aws_session import REGION, client_config, configure_clients, get_account, run_scoped, set_session
+from aws_modules.response_cache import configure_cache, get_cache
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+ROLE_SESSION_NAME = 'cis-checks'
+
+
+# session whose credentials are re-assumed from role_arn before they expire
+def assume_role_session(role_arn, region=REGION):
+    sts_client = boto3.session.Session().client('sts', region_name=region, config=client_config())
+
+    def refresh():
+        credentials = sts_client.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    botocore_session = get_botocore_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(),
+        refresh_using=refresh,
+        method='sts-assume-role')
+    botocore_session.set_config_variable('region', region)
+
+    return boto3.session.Session(botocore_session=botocore_session)
+
+
+# spawned workers start clean: no clients or SQLite handles copied across the
+# fork, so the cache and client pools are set up again in each
+def init_account_worker(cache_settings, bucket_workers):
+    if cache_settings:
+        configure_cache(*cache_settings)
+    configure_clients(bucket_workers)
+
+
+# runs in a worker process: the full CIS suite for one account
+@run_scoped
+def check_account(role_arn, all_regions=False, regions=None, bucket_workers=1):
+    set_session(assume_role_session(role_arn))
+    account = get_account()
+    LOGGER.info(f'Checking AWS acct {account} via {role_arn}')
+
+    # enabled regions are looked up per account when none are given
+    if all_regions:
+        return account, check_all_regions(regions, bucket_workers=bucket_workers)
+
+    return account, check_region(REGION, bucket_workers, all_buckets=True)
+
+
+def check_accounts(role_arns, workers=4, all_regions=False, regions=None, bucket_workers=1):
+    account_issues = {}
+    cache = get_cache()
+
+    cache_settings = (cache.path, cache.max_age, cache.max_entries) if cache else None
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_account_worker,
+        initargs=(cache_settings, bucket_workers))
+
+    with executor:
+        futures = {
+            executor.submit(check_account, role_arn, all_regions, regions, bucket_workers): role_arn
+            for role_arn in role_arns
+        }
+
+        # collected as each account finishes so large accounts don't hold up the rest
+        for future in as_completed(futures):
+            role_arn = futures[future]
+
+            try:
+                account, issues = future.result()
+                account_issues[account] = issues
+
+            except Exception as err:
+                LOGGER.error(f'Unable to check {role_arn}: {err}')
+                account_issues[role_arn] = {'exception': str(err)}
+
+    return account_issues
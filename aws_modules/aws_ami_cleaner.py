@@ -1,28 +1,65 @@
 #! /usr/bin/python3
 
-from typing import Iterator
-import boto3
+import argparse
+import gzip
+import heapq
+import json
+import re
 from botocore.exceptions import ClientError, ParamValidationError
 from datetime import datetime, timedelta, timezone
 
+from aws_modules.api_metrics import add_metrics_args, report_metrics, start_metrics
+from aws_modules.aws_regions import run_in_regions
+from aws_modules.aws_session import REGION, configure_clients, get_client
+from aws_modules.cassette import add_cassette_args, start_recording, start_replay
+from aws_modules.deletion_executor import MUTATION_RATE, DeletionExecutor
+
 import logging
 logging.basicConfig(level=logging.INFO)
 
 LOGGER = logging.getLogger()
 TODAY = datetime.now(tz=timezone.utc)
-REGION = 'us-gov-west-1'
-EC2_CLIENT = boto3.client('ec2', region_name=REGION)
-EC2_RESOURCE = boto3.resource('ec2', region_name=REGION)
-
 
-def main():
-    ami_iterable = get_amis()
-    amis_sorted = sort_amis(ami_iterable)
-    print(f"{len(amis_sorted)}")
-    builds_to_keep = keep_latest_amis(amis_sorted)
-    amis = deregister_amis(builds_to_keep, ami_iterable)
-    delete_snapshots(amis[0])
-    delete_volumes()
+# EC2 caps the values in a single filter
+FILTER_VALUES_MAX = 200
+# describe_volumes returns at most 500 volumes per page
+VOLUME_PAGE_SIZE = 500
+# bumped whenever the inventory file layout changes
+INVENTORY_VERSION = 1
+# terminated instances can no longer be launched from, they hold no AMI
+INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+# fleets in these states still launch new instances from their templates
+FLEET_STATES = ['submitted', 'active', 'modifying']
+# resolved to whatever version they point at when templates are described
+TEMPLATE_ALIASES = ('$Latest', '$Default')
+# "Created by CreateImage(i-0123...) for ami-0123... from vol-0123..."
+AMI_ID_PATTERN = re.compile(r'\bami-[0-9a-f]{8,17}\b')
+
+
+def main(region: str = REGION, workers: int = 8, mutation_rate: float = MUTATION_RATE) -> dict:
+    executor = DeletionExecutor(region, workers, mutation_rate)
+    images = get_amis(region)
+    ami_index = index_amis(images)
+    print(f"{len(images)}")
+    builds_to_keep = keep_latest_amis(ami_index)
+    # snapshots are read off the images before they are deregistered
+    snapshot_index = index_ami_snapshots(images)
+    amis = deregister_amis(builds_to_keep, images, region, executor)
+    # only snapshots of AMIs that were actually deregistered can be deleted
+    delete_snapshots(amis[0], snapshot_index, region, executor)
+    delete_volumes(region=region, executor=executor)
+
+    return {
+        'deregistered': amis[0],
+        'retained': amis[1],
+        'summary': executor.summary(),
+        'failed': executor.failures(),
+    }
+
+
+# the live pass in every enabled region at once, results keyed by region
+def clean_amis_all_regions(regions: list = None, workers: int = None) -> dict:
+    return run_in_regions(main, regions, workers)
 
 
 def print_list(print_this: list):
@@ -32,22 +69,28 @@ def print_list(print_this: list):
 
 # AMIs
 
-def get_amis() -> Iterator:
+# images are fetched once, every later step works from this list
+def get_amis(region: str = REGION) -> list:
     try:
         # TODO update Values for RHEL 8?
-        return EC2_RESOURCE.images.filter(
-            Filters=[
-                {
-                    'Name': 'name',
-                    'Values': ['*RHEL-*']
-                },
-                {
-                    'Name': 'tag:Description',
-                    'Values': ['packer*', '*RHEL*', 'Spel*']
-                },
-            ],
-            Owners=['self']
-        )
+        paginator = get_client('ec2', region).get_paginator('describe_images')
+        return [
+            image
+            for page in paginator.paginate(
+                Filters=[
+                    {
+                        'Name': 'name',
+                        'Values': ['*RHEL-*']
+                    },
+                    {
+                        'Name': 'tag:Description',
+                        'Values': ['packer*', '*RHEL*', 'Spel*']
+                    },
+                ],
+                Owners=['self']
+            )
+            for image in page['Images']
+        ]
 
     except ClientError as api_err:
         error_code = api_err.response['Error']['Code']
@@ -61,96 +104,170 @@ def get_amis() -> Iterator:
         LOGGER.error(f"Unexpected error: {err}")
         raise
 
+    return []
+
 
-def sort_amis(amis: list = []) -> list:
-    if not amis:
+# AMI names end in a build timestamp: <build name>-<timestamp>
+def get_build_name(ami_name: str) -> str:
+    return ami_name.rpartition('-')[0]
+
+
+# build name -> names of that build's AMIs
+def index_amis(images: list) -> dict:
+    if not images:
         print("No AMIs found matching filter.")
-        return []
+        return {}
 
-    ami_names = []
+    ami_index = {}
 
-    try:
-        for ami in amis:
-            ami_names.append(ami.name)
+    for image in images:
+        ami_index.setdefault(get_build_name(image['Name']), []).append(image['Name'])
 
-        #  reverse order for latest based on timestamp
-        ami_names.sort(reverse=True)
+    return ami_index
 
-    except ClientError as api_err:
-        error_code = api_err.response['Error']['Code']
-        error_message = api_err.response['Error']['Message']
-        LOGGER.error(f"AWS API Error: {error_code} - {error_message}")
 
-    except (KeyError, ValueError, ParamValidationError) as data_err:
-        LOGGER.error(f"Error during data processing: {data_err}")
+def keep_latest_amis(ami_index: dict, retain_no: int = 10) -> set:
+    if not ami_index:
+        print("No AMIs up for deregistering.")
+        return set()
 
-    except Exception as err:
-        LOGGER.error(f"Unexpected error: {err}")
-        raise
+    builds = set()
 
-    return ami_names
+    #  latest retain_no per build based on timestamp
+    for ami_names in ami_index.values():
+        builds.update(heapq.nlargest(retain_no, ami_names))
 
+    return builds
 
-def keep_latest_amis(ami_names: list = [], retain_no: int = 10) -> list:
-    if not ami_names:
-        print("No AMIs up for deregistering.")
-        return []
 
-    builds = []
-    build_names = []
-    count = 0
+# launch template specifications of Auto Scaling groups, EC2 Fleets and
+# Spot Fleets, mixed instances policies and their overrides included
+def get_template_specs(region: str = REGION) -> list:
+    ec2_client = get_client('ec2', region)
+    specs = []
 
-    try:
-        for ami_name in ami_names:
-            str_array = ami_name.split('-')
-            str_array.pop()
-            build_name = '-'.join(str_array)
+    # aws autoscaling describe-auto-scaling-groups
+    paginator = get_client('autoscaling', region).get_paginator('describe_auto_scaling_groups')
+    for group in paginator.paginate().search('AutoScalingGroups[]'):
+        specs.append(group.get('LaunchTemplate'))
+        mixed_template = group.get('MixedInstancesPolicy', {}).get('LaunchTemplate', {})
+        specs.append(mixed_template.get('LaunchTemplateSpecification'))
+        specs.extend(override.get('LaunchTemplateSpecification') for override in mixed_template.get('Overrides', []))
 
-            if build_name not in build_names:
-                build_names.append(build_name)
-                count = 1
+    # aws ec2 describe-fleets --filters Name=fleet-state,Values=submitted,active,modifying
+    paginator = ec2_client.get_paginator('describe_fleets')
+    pages = paginator.paginate(Filters=[{'Name': 'fleet-state', 'Values': FLEET_STATES}])
+    specs.extend(pages.search('Fleets[].LaunchTemplateConfigs[].LaunchTemplateSpecification'))
 
-            if (count <= retain_no) and (build_name in build_names):
-                builds.append(ami_name)
-                count += 1
+    # aws ec2 describe-spot-fleet-requests
+    paginator = ec2_client.get_paginator('describe_spot_fleet_requests')
+    for spot_fleet in paginator.paginate().search('SpotFleetRequestConfigs[]'):
+        if spot_fleet['SpotFleetRequestState'] in FLEET_STATES:
+            specs.extend(
+                config.get('LaunchTemplateSpecification')
+                for config in spot_fleet['SpotFleetRequestConfig'].get('LaunchTemplateConfigs', []))
 
-    except ValueError as data_err:
-        LOGGER.error(f"Error during data processing: {data_err}")
+    return [spec for spec in specs if spec]
 
-    except Exception as err:
-        LOGGER.error(f"Unexpected error: {err}")
+
+# template (id or name) -> numbered versions something launches from;
+# $Latest and $Default are described for every template anyway
+def get_pinned_template_versions(region: str = REGION) -> dict:
+    pinned = {}
+
+    for spec in get_template_specs(region):
+        version = str(spec.get('Version', '$Default'))
+
+        if version not in TEMPLATE_ALIASES:
+            if spec.get('LaunchTemplateId'):
+                template = ('LaunchTemplateId', spec['LaunchTemplateId'])
+            else:
+                template = ('LaunchTemplateName', spec['LaunchTemplateName'])
+            pinned.setdefault(template, set()).add(version)
+
+    return pinned
+
+
+# image IDs still referenced by instances, launch templates or launch
+# configurations; instances are filtered server-side to candidate_ids
+def get_ami_dependencies(candidate_ids: list, region: str = REGION) -> set:
+    ec2_client = get_client('ec2', region)
+    dependencies = set()
+
+    try:
+        # aws ec2 describe-instances --filters Name=image-id,Values=<ami_ids> --query Reservations[].Instances[].ImageId
+        paginator = ec2_client.get_paginator('describe_instances')
+        for start in range(0, len(candidate_ids), FILTER_VALUES_MAX):
+            pages = paginator.paginate(
+                Filters=[
+                    {
+                        'Name': 'image-id',
+                        'Values': candidate_ids[start:start + FILTER_VALUES_MAX]
+                    },
+                    {
+                        'Name': 'instance-state-name',
+                        'Values': INSTANCE_STATES
+                    }
+                ]
+            )
+            dependencies.update(pages.search('Reservations[].Instances[].ImageId'))
+
+        # aws ec2 describe-launch-template-versions --versions '$Latest' '$Default'
+        paginator = ec2_client.get_paginator('describe_launch_template_versions')
+        pages = paginator.paginate(Versions=['$Latest', '$Default'])
+        dependencies.update(pages.search('LaunchTemplateVersions[].LaunchTemplateData.ImageId'))
+
+        # aws ec2 describe-launch-template-versions --launch-template-id <id> --versions <pinned versions>
+        for (template_param, template), versions in get_pinned_template_versions(region).items():
+            pages = paginator.paginate(**{template_param: template, 'Versions': sorted(versions)})
+            dependencies.update(pages.search('LaunchTemplateVersions[].LaunchTemplateData.ImageId'))
+
+        # aws autoscaling describe-launch-configurations --query LaunchConfigurations[].ImageId
+        paginator = get_client('autoscaling', region).get_paginator('describe_launch_configurations')
+        dependencies.update(paginator.paginate().search('LaunchConfigurations[].ImageId'))
+
+    except ClientError as api_err:
+        # without the full dependency set nothing is safe to deregister
+        error_code = api_err.response['Error']['Code']
+        error_message = api_err.response['Error']['Message']
+        LOGGER.error(f"AWS API Error: {error_code} - {error_message}")
         raise
 
-    return builds
+    dependencies.discard(None)
+    return dependencies
 
 
-def deregister_amis(keep_builds: list, ami_iterable: Iterator) -> tuple:
+# keep the latest builds and anything still launched from, deregister the rest;
+# a plan only says what it would deregister
+def select_amis(keep_builds: set, images: list, dependencies: set, action: str = 'deregistering') -> tuple:
+    amis_retained = []
+    amis_to_deregister = []
+
+    for ami in images:
+        if (ami['Name'] in keep_builds) or (ami['ImageId'] in dependencies):
+            print(f"keep {ami['ImageId']} for {ami['Name']}")
+            amis_retained.append(ami['ImageId'])
+        else:
+            print(f" - {action} {ami['ImageId']} for {ami['Name']}")
+            amis_to_deregister.append(ami['ImageId'])
+
+    return (amis_to_deregister, amis_retained)
+
+
+def deregister_amis(keep_builds: set, images: list, region: str = REGION, executor: DeletionExecutor = None) -> tuple:
     if not keep_builds:
         print("No AMIs to deregister.")
         return ([], [])
 
-    ec2_dependencies = []
     amis_retained = []
-    amis_deregistered = []
+    amis_to_deregister = []
 
     # check for images currently associated to existing EC2s
-    for instance in EC2_RESOURCE.instances.all():
-        ec2_dependencies.append(instance.image_id)
+    candidate_ids = [ami['ImageId'] for ami in images if ami['Name'] not in keep_builds]
+    ec2_dependencies = get_ami_dependencies(candidate_ids, region)
 
     try:
-        for ami in ami_iterable:
-            if (ami.name in keep_builds) or (ami.image_id in ec2_dependencies):
-                print(f"keep {ami.image_id} for {ami.name}")
-                amis_retained.append(ami.image_id)
-            else:
-                print(f" - deregistering {ami.image_id} for {ami.name}")
-                amis_deregistered.append(ami.image_id)
-                ami.deregister()
-
-    except ClientError as api_err:
-        error_code = api_err.response['Error']['Code']
-        error_message = api_err.response['Error']['Message']
-        LOGGER.error(f"AWS API Error: {error_code} - {error_message}")
+        amis_to_deregister, amis_retained = select_amis(keep_builds, images, ec2_dependencies)
 
     except (KeyError, ValueError, ParamValidationError) as data_err:
         LOGGER.error(f"Error during data processing: {data_err}")
@@ -159,31 +276,67 @@ def deregister_amis(keep_builds: list, ami_iterable: Iterator) -> tuple:
         LOGGER.error(f"Unexpected error: {err}")
         raise
 
+    executor = executor or DeletionExecutor(region)
+    amis_deregistered = executor.succeeded(executor.run('image', amis_to_deregister))
+
     return (amis_deregistered, amis_retained)
 
 
 # Snapshots
 
 
-def get_snapshots() -> list:
+# AMI ID -> snapshot IDs, from each image's block device mappings
+def index_ami_snapshots(images: list) -> dict:
+    snapshot_index = {}
+
+    for image in images:
+        snapshot_ids = [
+            mapping['Ebs']['SnapshotId']
+            for mapping in image.get('BlockDeviceMappings', [])
+            if 'SnapshotId' in mapping.get('Ebs', {})
+        ]
+
+        if snapshot_ids:
+            snapshot_index[image['ImageId']] = snapshot_ids
+
+    return snapshot_index
+
+
+# AMI ID -> snapshot IDs, parsed from CreateImage snapshot descriptions
+def index_snapshot_descriptions(snapshots: list) -> dict:
+    snapshot_index = {}
+
+    for snapshot in snapshots:
+        for ami_id in AMI_ID_PATTERN.findall(snapshot.get('Description', '')):
+            snapshot_index.setdefault(ami_id, []).append(snapshot['SnapshotId'])
+
+    return snapshot_index
+
+
+def get_snapshots(region: str = REGION) -> list:
     try:
-        return EC2_RESOURCE.snapshots.filter(
-            Filters=[
-                {
-                    'Name': 'status',
-                    'Values': ['completed']
-                },
-                {
-                    'Name': 'description',
-                    'Values': ['Created by CreateImage*']
-                },
-                {
-                    'Name': 'tag:Description',
-                    'Values': ['*RHEL*', 'packer image*']
-                }
-            ],
-            OwnerIds=['self']
-        )
+        paginator = get_client('ec2', region).get_paginator('describe_snapshots')
+        return [
+            snapshot
+            for page in paginator.paginate(
+                Filters=[
+                    {
+                        'Name': 'status',
+                        'Values': ['completed']
+                    },
+                    {
+                        'Name': 'description',
+                        'Values': ['Created by CreateImage*']
+                    },
+                    {
+                        'Name': 'tag:Description',
+                        'Values': ['*RHEL*', 'packer image*']
+                    }
+                ],
+                OwnerIds=['self']
+            )
+            for snapshot in page['Snapshots']
+        ]
 
     except ClientError as api_err:
         error_code = api_err.response['Error']['Code']
@@ -197,52 +350,51 @@ def get_snapshots() -> list:
         LOGGER.error(f"Unexpected error: {err}")
         raise
 
+    return []
 
-def delete_snapshots(amis_deregistered: list = []):
-    snapshots = get_snapshots()
 
-    if (not amis_deregistered) or (not snapshots):
+def delete_snapshots(amis_deregistered: list = [], snapshot_index: dict = {}, region: str = REGION, executor: DeletionExecutor = None):
+    if not amis_deregistered:
         print("No snapshots associated to AMIs for deletion.")
         return []
 
-    try:
-        for snapshot in snapshots:
-            for ami_id in amis_deregistered:
-                # TODO add logic to delete snapshots older than 6 months or longer and not associated to EC2 resources
+    # descriptions are only searched for AMIs without mapped snapshots
+    if any(ami_id not in snapshot_index for ami_id in amis_deregistered):
+        described = index_snapshot_descriptions(get_snapshots(region))
+        snapshot_index = {**described, **snapshot_index}
 
-                if (ami_id in snapshot.description):
-                    print(
-                        f" - deleting snapshot {snapshot.id} for {ami_id}...")
-                    amis_deregistered.remove(ami_id)
-                    snapshot.delete()
-                    break
+    # TODO add logic to delete snapshots older than 6 months or longer and not associated to EC2 resources
+    snapshots_to_delete = []
 
-    except ClientError as api_err:
-        error_code = api_err.response['Error']['Code']
-        error_message = api_err.response['Error']['Message']
-        LOGGER.error(f"AWS API Error: {error_code} - {error_message}")
-
-    except (KeyError, ValueError, ParamValidationError) as data_err:
-        LOGGER.error(f"Error during data processing: {data_err}")
+    for ami_id in amis_deregistered:
+        for snapshot_id in snapshot_index.get(ami_id, []):
+            print(
+                f" - deleting snapshot {snapshot_id} for {ami_id}...")
+            snapshots_to_delete.append(snapshot_id)
 
-    except Exception as err:
-        LOGGER.error(f"Unexpected error: {err}")
-        raise
+    executor = executor or DeletionExecutor(region)
+    return executor.succeeded(executor.run('snapshot', snapshots_to_delete))
 
 
 # EBS Volumes
 
 
-def get_volumes() -> list:
+# in-use volumes are never deleted, so the state filter runs server-side and
+# only the fields needed to decide are kept from each page
+def get_volumes(region: str = REGION, page_size: int = VOLUME_PAGE_SIZE):
+    # aws ec2 describe-volumes --filters Name=status,Values=available --query 'Volumes[].[VolumeId,CreateTime]'
     try:
-        return EC2_CLIENT.describe_volumes(
+        paginator = get_client('ec2', region).get_paginator('describe_volumes')
+        pages = paginator.paginate(
             Filters=[
                 {
                     'Name': 'status',
-                    'Values': ['available', 'in-use']
+                    'Values': ['available']
                 }
-            ]
-        )['Volumes']
+            ],
+            PaginationConfig={'PageSize': page_size}
+        )
+        yield from pages.search('Volumes[].[VolumeId, CreateTime]')
 
     except ClientError as api_err:
         error_code = api_err.response['Error']['Code']
@@ -257,37 +409,214 @@ def get_volumes() -> list:
         raise
 
 
-def delete_volumes(days_to_retain_volume: int = 1096):
-    volumes = get_volumes()
+# EC2 has no server-side filter on volume age, so it is applied as pages stream in
+def get_expired_volumes(volumes, volume_retention_date: datetime):
+    for volume_id, create_time in volumes:
+        if create_time >= volume_retention_date:
+            print(f"{volume_id} to be retained - available")
+        else:
+            print(f"{volume_id} to be deleted - available")
+            yield volume_id
 
-    if not volumes:
-        print("No volumes up for removal.")
-        return
 
+def delete_volumes(days_to_retain_volume: int = 1096, region: str = REGION, executor: DeletionExecutor = None) -> list:
     volume_retention_date = TODAY - timedelta(days=days_to_retain_volume)
+    executor = executor or DeletionExecutor(region)
 
-    try:
-        for volume in volumes:
-            if (volume['CreateTime'] >= volume_retention_date) or (volume['State'] == 'in-use'):
-                print(
-                    f"{volume['VolumeId']} to be retained - {volume['State']}")
-            else:
-                print(
-                    f"{volume['VolumeId']} to be deleted - {volume['State']}")
-                EC2_CLIENT.delete_volume(VolumeId=volume['VolumeId'])
+    # the executor pulls candidates as it has room for them, so only a page
+    # of volumes is held at a time
+    volumes_deleted = executor.succeeded(
+        executor.run('volume', get_expired_volumes(get_volumes(region), volume_retention_date)))
 
-    except ClientError as api_err:
-        error_code = api_err.response['Error']['Code']
-        error_message = api_err.response['Error']['Message']
-        LOGGER.error(f"AWS API Error: {error_code} - {error_message}")
+    if not volumes_deleted:
+        print("No volumes up for removal.")
 
-    except (KeyError, ValueError, ParamValidationError) as data_err:
-        LOGGER.error(f"Error during data processing: {data_err}")
+    return volumes_deleted
 
-    except Exception as err:
-        LOGGER.error(f"Unexpected error: {err}")
-        raise
+
+# Offline plan/apply
+
+# inventories are written by plan and read by replan and apply:
+#   python -m aws_modules.aws_ami_cleaner plan --inventory amis.json.gz
+#   python -m aws_modules.aws_ami_cleaner replan --inventory amis.json.gz --retain-no 5
+#   python -m aws_modules.aws_ami_cleaner apply --inventory amis.json.gz --dry-run
+
+
+# everything a plan is computed from, reduced to IDs, names and dates
+def take_inventory(region: str = REGION) -> dict:
+    images = get_amis(region)
+    image_ids = [image['ImageId'] for image in images]
+    snapshot_index = index_ami_snapshots(images)
+
+    if any(image_id not in snapshot_index for image_id in image_ids):
+        described = index_snapshot_descriptions(get_snapshots(region))
+        snapshot_index = {**described, **snapshot_index}
+
+    # any image can become a candidate when the plan is redone with a
+    # different retain_no, so dependencies are looked up for all of them
+    dependencies = get_ami_dependencies(image_ids, region)
+
+    return {
+        'version': INVENTORY_VERSION,
+        'region': region,
+        'taken': datetime.now(tz=timezone.utc).isoformat(),
+        'images': [[image['ImageId'], image['Name']] for image in images],
+        'snapshots': {image_id: snapshot_index[image_id] for image_id in image_ids if image_id in snapshot_index},
+        'dependencies': [image_id for image_id in image_ids if image_id in dependencies],
+        'volumes': [[volume_id, create_time.isoformat()] for volume_id, create_time in get_volumes(region)],
+    }
+
+
+def plan_cleanup(inventory: dict, retain_no: int = 10, days_to_retain_volume: int = 1096) -> dict:
+    images = [{'ImageId': image_id, 'Name': name} for image_id, name in inventory['images']]
+    keep_builds = keep_latest_amis(index_amis(images), retain_no)
+    amis_to_deregister, amis_retained = select_amis(
+        keep_builds, images, set(inventory['dependencies']), 'would deregister')
+
+    volume_retention_date = TODAY - timedelta(days=days_to_retain_volume)
+    volumes = ((volume_id, datetime.fromisoformat(create_time)) for volume_id, create_time in inventory['volumes'])
+
+    return {
+        'retain_no': retain_no,
+        'days_to_retain_volume': days_to_retain_volume,
+        'images': amis_to_deregister,
+        'retained': amis_retained,
+        'snapshots': {
+            image_id: inventory['snapshots'][image_id]
+            for image_id in amis_to_deregister
+            if image_id in inventory['snapshots']
+        },
+        'volumes': list(get_expired_volumes(volumes, volume_retention_date)),
+    }
+
+
+# executes a reviewed plan as written, nothing is rediscovered
+def apply_plan(inventory: dict, workers: int = 8, mutation_rate: float = MUTATION_RATE, dry_run: bool = False) -> dict:
+    plan = inventory['plan']
+    executor = DeletionExecutor(inventory['region'], workers, mutation_rate, dry_run=dry_run)
+
+    amis_deregistered = executor.succeeded(executor.run('image', plan['images']))
+    # only snapshots of AMIs that were actually deregistered can be deleted
+    snapshot_ids = (
+        snapshot_id
+        for image_id in amis_deregistered
+        for snapshot_id in plan['snapshots'].get(image_id, [])
+    )
+    executor.run('snapshot', snapshot_ids)
+    executor.run('volume', plan['volumes'])
+
+    return {
+        'deregistered': amis_deregistered,
+        'retained': plan['retained'],
+        'summary': executor.summary(),
+        'failed': executor.failures(),
+    }
+
+
+def open_inventory(path: str, mode: str):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+def save_inventory(inventory: dict, path: str):
+    with open_inventory(path, 'wt') as inventory_file:
+        json.dump(inventory, inventory_file, separators=(',', ':'))
+
+
+def load_inventory(path: str) -> dict:
+    with open_inventory(path, 'rt') as inventory_file:
+        inventory = json.load(inventory_file)
+
+    if inventory.get('version') != INVENTORY_VERSION:
+        raise ValueError(f"{path} is not a version {INVENTORY_VERSION} AMI inventory")
+
+    return inventory
+
+
+def print_plan(inventory: dict):
+    plan = inventory['plan']
+    snapshot_count = sum(len(snapshot_ids) for snapshot_ids in plan['snapshots'].values())
+    print(
+        f"inventory of {inventory['region']} taken {inventory['taken']}: "
+        f"retain_no={plan['retain_no']} days_to_retain_volume={plan['days_to_retain_volume']}")
+    print(
+        f"{len(plan['images'])} AMIs to deregister, {len(plan['retained'])} retained, "
+        f"{snapshot_count} snapshots and {len(plan['volumes'])} volumes to delete")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='AMI, snapshot and volume cleanup')
+    parser.add_argument('--region', default=REGION)
+    parser.add_argument('--all-regions', action='store_true',
+                        help='run the live cleanup in all enabled regions')
+    parser.add_argument('--regions', nargs='+', default=None,
+                        help='regions to clean with --all-regions (default: all enabled)')
+    add_cassette_args(parser)
+    add_metrics_args(parser)
+    subparsers = parser.add_subparsers(dest='command')
+
+    plan_parser = subparsers.add_parser('plan', help='take an inventory and write it with a deletion plan')
+    replan_parser = subparsers.add_parser('replan', help='redo the plan of an inventory offline')
+    for subparser in (plan_parser, replan_parser):
+        subparser.add_argument('--inventory', required=True, metavar='PATH',
+                               help='inventory file, gzipped when PATH ends in .gz')
+        subparser.add_argument('--retain-no', type=int, default=10,
+                               help='AMIs kept per build')
+        subparser.add_argument('--days-to-retain-volume', type=int, default=1096,
+                               help='age in days before an available volume is deleted')
+
+    apply_parser = subparsers.add_parser('apply', help='execute the plan of an inventory')
+    apply_parser.add_argument('--inventory', required=True, metavar='PATH')
+    apply_parser.add_argument('--workers', type=int, default=8,
+                              help='number of deletions in flight')
+    apply_parser.add_argument('--dry-run', action='store_true',
+                              help='send every call with DryRun set')
+    return parser.parse_args()
+
+
+def run_command(args):
+    if args.command == 'plan':
+        inventory = take_inventory(args.region)
+        inventory['plan'] = plan_cleanup(inventory, args.retain_no, args.days_to_retain_volume)
+        save_inventory(inventory, args.inventory)
+        print_plan(inventory)
+
+    elif args.command == 'replan':
+        inventory = load_inventory(args.inventory)
+        inventory['plan'] = plan_cleanup(inventory, args.retain_no, args.days_to_retain_volume)
+        save_inventory(inventory, args.inventory)
+        print_plan(inventory)
+
+    elif args.command == 'apply':
+        result = apply_plan(load_inventory(args.inventory), args.workers, dry_run=args.dry_run)
+        print(f"{result['summary']}")
+        print_list(result['failed'])
+
+    elif args.all_regions:
+        for region, result in clean_amis_all_regions(args.regions).items():
+            print(f"{region}: {result['summary']}")
+            print_list(result['failed'])
+
+    else:
+        main(args.region)
 
 
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    # apply takes its own worker count, the live pass deletes with 8
+    configure_clients(getattr(args, 'workers', 8))
+
+    if args.replay:
+        start_replay(args.replay, args.replay_latency)
+    elif args.record:
+        cassette = start_recording()
+
+    metrics = start_metrics() if args.metrics or args.metrics_file else None
+
+    try:
+        run_command(args)
+
+    finally:
+        if args.record and not args.replay:
+            cassette.save(args.record)
+        if metrics is not None:
+            report_metrics(metrics, args.metrics_file)
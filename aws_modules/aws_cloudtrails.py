@@ -1,24 +1,19 @@
-import boto3
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from aws_modules.cis_error_logger import cis_issue_logger
+from aws_modules.aws_s3 import get_bucket_snapshot, log_snapshot_errors, snapshot_bucket_names
+from aws_modules.aws_session import REGION, get_account, get_client, get_trails, memoise, run_scoped
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.concurrency import gather_limited, get_limiter, is_throttle, scan_adaptive
+from aws_modules.response_cache import cached_call
 
 from botocore.exceptions import ClientError
 import logging
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger()
 
-REGION = 'us-gov-west-1'
-
-STS_CLIENT = boto3.client('sts', region_name=REGION)
-AWS_ACCOUNT = STS_CLIENT.get_caller_identity().get('Account')
-
-CLOUDTRAIL_CLIENT = boto3.client('cloudtrail', region_name=REGION)
-TRAILS = CLOUDTRAIL_CLIENT.describe_trails()['trailList']
-
-S3_CLIENT = boto3.client("s3", region_name=REGION)
-BUCKETS = S3_CLIENT.list_buckets()['Buckets']
-
 
 '''
 $ aws cloudtrail get-event-selectors --trail-name cloudtrail-multi-region
@@ -64,131 +59,354 @@ $ aws configservice describe-configuration-recorder-status
     ]
 }
 
-3.7
+3.7, 3.8: see aws_cmk
 aws cloudtrail describe-trails --region us-gov-west-1 --query trailList[*].KmsKeyId
 '''
 
 
-def check_cloudtrail(trail_issues={}):
-    count = 0
-    # at least one trail is Multi-regional
-    is_multi_regional = False
+# trail field -> (CloudTrail API call, trail name parameter); trails are
+# named by ARN, the only name a shadow trail answers to outside its home region
+TRAIL_FIELDS = {
+    'status': ('get_trail_status', 'Name'),
+    'event_selectors': ('get_event_selectors', 'TrailName'),
+}
 
-    for trail in TRAILS:
-        trail_name = trail['Name']
-        bucket_name = trail['S3BucketName']
 
-        try:
-            if trail['IsMultiRegionTrail']:
-                is_multi_regional = True
-                LOGGER.info(f'Multi region is enabled for {trail_name}')
+# per-trail status and event selectors gathered once per run and shared by
+# every check; failed calls keep their ClientError in errors
+class TrailSnapshot:
+    __slots__ = ('name', 'status', 'event_selectors', 'errors', 'fetched')
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.event_selectors = None
+        self.errors = {}
+        self.fetched = set()
+
+
+def trail_arn(trail):
+    return trail.get('TrailARN', trail['Name'])
+
 
-            cis_id = "3.2"
-            if trail['LogFileValidationEnabled']:
-                LOGGER.info(f'Logfile validation is enabled for {trail_name}')
-            else:
-                msg = "Logfile validation is NOT enabled"
-                LOGGER.warning(f'{msg} for {trail_name}')
+# describe_trails lists multi-region trails in every region; outside their
+# home region these shadow copies only count for 3.1
+def home_trails(trails, region=REGION):
+    return [trail for trail in trails if trail.get('HomeRegion', region) == region]
 
-                trail_issues = cis_issue_logger(trail_name, trail_issues, cis_id)
 
-        except CLOUDTRAIL_CLIENT.exceptions.from_code('TrailNotFoundException'):
-            msg = 'NO Trail'
-            LOGGER.error(f'{msg} for {trail_name}')
+def shadow_trails(trails, region=REGION):
+    return [trail for trail in trails if trail.get('HomeRegion', region) != region]
 
-            if trail_name not in trail_issues.keys():
-                trail_issues[trail_name] = {}
-            if msg not in trail_issues[trail_name].values():
-                trail_issues[trail_name].update({'exception': msg})
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {trail_name}')
+def get_trail_snapshot(trail, fields=tuple(TRAIL_FIELDS), region=REGION):
+    trail_name = trail['Name']
+    snapshot = memoise(('trail_snapshot', region, trail_arn(trail)), lambda: TrailSnapshot(trail_name))
+    cloudtrail_client = get_client('cloudtrail', region)
+
+    for field in fields:
+        if field in snapshot.fetched:
+            continue
+
+        api_call, name_param = TRAIL_FIELDS[field]
+
+        try:
+            response = cached_call(get_account(), cloudtrail_client, api_call, **{name_param: trail_arn(trail)})
+            setattr(snapshot, field, response)
 
         except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+            # throttled fields stay unfetched, the caller retries the trail
+            if is_throttle(client_error):
+                raise
+            snapshot.errors[field] = client_error
+
+        snapshot.fetched.add(field)
+
+    return snapshot
+
+
+# one lookup per trail and field, so a trail's status and event selectors
+# are fetched side by side
+def fetch_trail_field(lookup, region=REGION):
+    trail, field = lookup
+    return get_trail_snapshot(trail, (field,), region)
+
+
+# still throttled after every retry: the error is kept like any other
+def trail_field_throttled(lookup, client_error, region=REGION):
+    trail, field = lookup
+    snapshot = get_trail_snapshot(trail, (), region)
+
+    if field not in snapshot.fetched:
+        snapshot.errors[field] = client_error
+        snapshot.fetched.add(field)
+
+    return snapshot
+
+
+# destination buckets in first-seen order; most trails share a few buckets
+def get_trail_buckets(trails):
+    return list(dict.fromkeys(trail['S3BucketName'] for trail in trails))
+
+
+def snapshot_trails(trails, fields=tuple(TRAIL_FIELDS), region=REGION, workers=1):
+    lookups = [(trail, field) for trail in trails for field in fields]
+
+    scan_adaptive(
+        functools.partial(fetch_trail_field, region=region), lookups,
+        get_limiter('cloudtrail', region, workers),
+        functools.partial(trail_field_throttled, region=region))
+
+
+async def snapshot_trails_async(trails, fields=tuple(TRAIL_FIELDS), region=REGION, limit=10):
+    lookups = [(trail, field) for trail in trails for field in fields]
+
+    await gather_limited(
+        functools.partial(fetch_trail_field, region=region), lookups, limit,
+        get_limiter('cloudtrail', region, limit),
+        functools.partial(trail_field_throttled, region=region))
+
+
+# logs a trail field's failed lookup, returns whether there was one
+def log_trail_errors(snapshot, field, trail_issues):
+    error = snapshot.errors.get(field)
+
+    if error is None:
+        return False
+
+    if error.response['Error']['Code'] == 'TrailNotFoundException':
+        msg = 'NO Trail'
+        LOGGER.error(f'{msg} for {snapshot.name}')
+
+        trail_issues.add_exception(snapshot.name, msg)
+
+    elif is_throttle(error):
+        msg = f'Throttled: {error}'
+        LOGGER.error(f'{msg} for {snapshot.name}')
+
+        trail_issues.add_exception(snapshot.name, msg)
+
+    else:
+        LOGGER.error(f'ClientError: {error}')
+
+    return True
+
+
+# CIS 3.1 only counts a multi-region trail that is logging and records
+# every management event, read and write
+def logs_all_management_events(event_selectors):
+    for selector in event_selectors.get('EventSelectors', []):
+        if selector.get('IncludeManagementEvents') and selector.get('ReadWriteType') == 'All':
+            return True
+
+    for selector in event_selectors.get('AdvancedEventSelectors', []):
+        field_selectors = {field['Field']: field for field in selector['FieldSelectors']}
+
+        if field_selectors.get('eventCategory', {}).get('Equals') == ['Management'] and 'readOnly' not in field_selectors:
+            return True
+
+    return False
+
+
+# per-trail checks cover the trails homed in region, shadow trails only
+# tell whether some other region's trail already covers this one for 3.1
+@run_scoped
+def check_cloudtrail(trail_issues=None, region=REGION, workers=1):
+    trail_issues = IssueStore() if trail_issues is None else trail_issues
+    all_trails = get_trails(region)
+    trails = home_trails(all_trails, region)
+    shadows = shadow_trails(all_trails, region)
+
+    snapshot_trails(trails + shadows, tuple(TRAIL_FIELDS), region, workers)
+    snapshot_bucket_names(get_trail_buckets(trails), ('logging',), workers, region)
+
+    return cloudtrail_issues(trails, shadows, trail_issues, region)
+
+
+# blocking steps run on a thread of their own, not on the loop or in its
+# default executor
+@run_scoped
+async def check_cloudtrail_async(trail_issues=None, region=REGION, limit=10):
+    trail_issues = IssueStore() if trail_issues is None else trail_issues
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        all_trails = await loop.run_in_executor(executor, get_trails, region)
+        trails = home_trails(all_trails, region)
+        shadows = shadow_trails(all_trails, region)
+
+        await asyncio.gather(
+            snapshot_trails_async(trails + shadows, tuple(TRAIL_FIELDS), region, limit),
+            loop.run_in_executor(executor, snapshot_bucket_names, get_trail_buckets(trails), ('logging',), limit, region))
+
+        return await loop.run_in_executor(executor, cloudtrail_issues, trails, shadows, trail_issues, region)
+
+    finally:
+        executor.shutdown(wait=False)
+
+
+def cloudtrail_issues(trails, shadows, trail_issues, region=REGION):
+    multi_regional = [cloudtrail_trail_issues(trail, trail_issues, region) for trail in trails]
+    # shadows are multi-region trails by definition
+    shadow_is_multi_regional = any(multi_region_trail_is_complete(trail, region) for trail in shadows)
+
+    return join_multi_region_issues(trails, multi_regional, trail_issues, shadow_is_multi_regional)
+
+
+# logs per-trail 3.2 and 3.6 issues from the fetched snapshots, returns
+# whether the trail counts as multi-regional for 3.1
+def cloudtrail_trail_issues(trail, trail_issues, region=REGION):
+    trail_name = trail['Name']
+    bucket_name = trail['S3BucketName']
+    is_multi_regional = False
+
+    try:
+        if trail['IsMultiRegionTrail']:
+            is_multi_regional = multi_region_trail_is_complete(trail, region)
+
+        cis_id = "3.2"
+        if trail['LogFileValidationEnabled']:
+            LOGGER.info(f'Logfile validation is enabled for {trail_name}')
+        else:
+            msg = "Logfile validation is NOT enabled"
+            LOGGER.warning(f'{msg} for {trail_name}')
+
+            trail_issues.add(trail_name, cis_id)
+
+    except KeyError as key_err:
+        msg = f"No such key {key_err} found"
+        LOGGER.error(f'{msg} for {trail_name}')
+
+    # the destination bucket's logging is looked up once, shared by its trails
+    bucket_snapshot = get_bucket_snapshot(bucket_name, ('logging',), region)
+
+    if log_snapshot_errors(bucket_snapshot, ('logging',)):
+        return is_multi_regional
+
+    cis_id = "3.6"
+    if bucket_snapshot.logging:
+        msg = 'Logging enabled'
+        # LOGGER.info(f'{msg} to {bucket_name} for {trail_name}')
+    else:
+        msg = "Logging not enabled"
+        LOGGER.warning(f'{msg} to {bucket_name} for {trail_name}')
+
+        trail_issues.add(trail_name, cis_id)
+
+    return is_multi_regional
+
+
+# a multi-region trail counts once it is logging all management events;
+# when status or selectors can't be read the trail's own flag is trusted
+def multi_region_trail_is_complete(trail, region=REGION):
+    trail_name = trail['Name']
+    snapshot = get_trail_snapshot(trail, tuple(TRAIL_FIELDS), region)
+
+    for field in TRAIL_FIELDS:
+        if field in snapshot.errors:
+            LOGGER.error(f'ClientError: {snapshot.errors[field]}')
+            return True
+
+    if not snapshot.status.get('IsLogging'):
+        LOGGER.warning(f'Multi region trail {trail_name} is not logging')
+        return False
+
+    if not logs_all_management_events(snapshot.event_selectors):
+        LOGGER.warning(f'Multi region trail {trail_name} does not log all management events')
+        return False
+
+    LOGGER.info(f'Multi region is enabled for {trail_name}')
+    return True
+
+
+# trails are joined in describe_trails order: every trail listed before the
+# first multi-regional one is flagged for 3.1
+def join_multi_region_issues(trails, multi_regional, trail_issues, is_multi_regional=False):
+    # at least one trail is Multi-regional
+
+    for trail, trail_is_multi_regional in zip(trails, multi_regional):
+        trail_name = trail['Name']
+        is_multi_regional = is_multi_regional or trail_is_multi_regional
 
         cis_id = "3.1"
         if(not is_multi_regional):
             msg = "Multi-region is not enabled for any trails"
             LOGGER.warning(f'{msg}')
 
-            trail_issues = cis_issue_logger(trail_name, trail_issues, cis_id)
+            trail_issues.add(trail_name, cis_id)
 
-        try:
-            response = S3_CLIENT.get_bucket_logging(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
-
-            cis_id = "3.6"
-            if (response['LoggingEnabled']):
-                msg = 'Logging enabled'
-                # LOGGER.info(f'{msg} to {bucket_name} for {trail_name}')
-            else:
-                msg = "Logging not enabled"
-                LOGGER.warning(f'{msg}')
-                
-                trail_issues = cis_issue_logger(trail_name, trail_issues, cis_id)
-
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
+    return trail_issues
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
 
-    count += 1
-    return trail_issues
+@run_scoped
+def check_cloudwatch_is_logging(trail_issues=None, region=REGION, workers=1):
+    trail_issues = IssueStore() if trail_issues is None else trail_issues
+    trails = home_trails(get_trails(region), region)
 
+    snapshot_trails(trails, ('status',), region, workers)
 
-def check_cloudwatch_is_logging(trail_issues={}):
-    count = 0
-    one_day_ago = int(datetime.now().timestamp()) - 86400
+    return cloudwatch_issues(trails, trail_issues, region)
 
-    for trail in TRAILS:
-        trail_name = trail['Name']
 
-        try:
-            response = CLOUDTRAIL_CLIENT.get_trail_status(Name=trail_name)
+@run_scoped
+async def check_cloudwatch_is_logging_async(trail_issues=None, region=REGION, limit=10):
+    trail_issues = IssueStore() if trail_issues is None else trail_issues
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        trails = home_trails(await loop.run_in_executor(executor, get_trails, region), region)
 
-            cis_id = '3.4'
-            if('CloudWatchLogsLogGroupArn' in trail.keys() and 'LatestCloudWatchLogsDeliveryTime' in response.keys()):
-                last_logged = int(response['LatestCloudWatchLogsDeliveryTime'].timestamp())
-                latest_log_time = datetime.fromtimestamp(last_logged)
-                msg = f'CloudWatch last logged at {latest_log_time}'
+        await snapshot_trails_async(trails, ('status',), region, limit)
 
-                if last_logged < one_day_ago:
-                    LOGGER.warning(f'OVERDUE: {msg} for {trail_name}')
+        return await loop.run_in_executor(executor, cloudwatch_issues, trails, trail_issues, region)
 
-                    trail_issues = cis_issue_logger(trail_name, trail_issues, cis_id)
+    finally:
+        executor.shutdown(wait=False)
 
-                # else:
-                #     LOGGER.info(f'{msg} for {trail_name}')
 
-            else:
-                msg = 'CloudWatch not being logged'
-                LOGGER.warning(f'{msg} for {trail_name}')
+def cloudwatch_issues(trails, trail_issues, region=REGION):
+    for trail in trails:
+        cloudwatch_trail_issues(trail, trail_issues, region)
 
-                trail_issues = cis_issue_logger(trail_name, trail_issues, cis_id)
+    return trail_issues
 
-        except CLOUDTRAIL_CLIENT.exceptions.from_code('TrailNotFoundException'):
-            msg = 'NO Trail'
-            LOGGER.error(f'{msg} for {trail_name}')
 
-            if trail_name not in trail_issues.keys():
-                trail_issues[trail_name] = {}
-            if msg not in trail_issues[trail_name].values():
-                trail_issues[trail_name].update({'exception': msg})
+def cloudwatch_trail_issues(trail, trail_issues, region=REGION):
+    trail_name = trail['Name']
+    one_day_ago = int(datetime.now().timestamp()) - 86400
+    snapshot = get_trail_snapshot(trail, ('status',), region)
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {trail_name}')
+    if log_trail_errors(snapshot, 'status', trail_issues):
+        return
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+    try:
+        response = snapshot.status
 
-    count += 1
-    return trail_issues
+        cis_id = '3.4'
+        if('CloudWatchLogsLogGroupArn' in trail.keys() and 'LatestCloudWatchLogsDeliveryTime' in response.keys()):
+            last_logged = int(response['LatestCloudWatchLogsDeliveryTime'].timestamp())
+            latest_log_time = datetime.fromtimestamp(last_logged)
+            msg = f'CloudWatch last logged at {latest_log_time}'
+
+            if last_logged < one_day_ago:
+                LOGGER.warning(f'OVERDUE: {msg} for {trail_name}')
+
+                trail_issues.add(trail_name, cis_id)
+
+            # else:
+            #     LOGGER.info(f'{msg} for {trail_name}')
+
+        else:
+            msg = 'CloudWatch not being logged'
+            LOGGER.warning(f'{msg} for {trail_name}')
+
+            trail_issues.add(trail_name, cis_id)
+
+    except KeyError as key_err:
+        msg = f"No such key {key_err} found"
+        LOGGER.error(f'{msg} for {trail_name}')
 
 
 # aws cloudtrail get-event-selectors --region us-gov-west-1 --trail-name <trail_name> --query EventSelectors[*].DataResources[]
@@ -0,0 +1,142 @@
+'''
+3.7
+$ aws cloudtrail describe-trails --region us-gov-west-1 --query trailList[*].KmsKeyId
+$ aws kms describe-key --region us-gov-west-1 --key-id <KmsKeyId> --query KeyMetadata.[KeyManager,KeyState]
+3.8
+$ aws kms list-keys --region us-gov-west-1
+$ aws kms describe-key --region us-gov-west-1 --key-id <key_id> --query KeyMetadata.[KeyManager,KeyState,Origin,KeySpec]
+$ aws kms get-key-rotation-status --region us-gov-west-1 --key-id <key_id>
+'''
+import functools
+
+from aws_modules.aws_cloudtrails import home_trails
+from aws_modules.aws_s3 import log_throttled
+from aws_modules.aws_session import REGION, get_account, get_client, get_trails, memoise, run_scoped
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.concurrency import get_limiter, is_throttle, scan_adaptive
+from aws_modules.response_cache import cached_call
+
+from botocore.exceptions import ClientError
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+# list_keys returns at most 1000 keys a page
+KEY_PAGE_SIZE = 1000
+
+
+# aws kms list-keys --region us-gov-west-1
+def get_keys(region=REGION):
+    paginator = get_client('kms', region).get_paginator('list_keys')
+    return list(paginator.paginate(PaginationConfig={'PageSize': KEY_PAGE_SIZE}).search('Keys[]'))
+
+
+# keys are described in their own region: arn:aws-us-gov:kms:<region>:<account>:key/<key_id>
+def key_region(key_id, region=REGION):
+    parts = key_id.split(':')
+    return parts[3] if len(parts) > 5 else region
+
+
+# who manages a key and its state hardly change, so the answer is cached;
+# a key shared by several trails and the rotation check is described once per run
+def describe_key(key_id, region=REGION):
+    kms_client = get_client('kms', key_region(key_id, region))
+    return memoise(
+        ('key_metadata', kms_client.meta.region_name, key_id),
+        lambda: cached_call(get_account(), kms_client, 'describe_key', KeyId=key_id)['KeyMetadata'])
+
+
+# rotation only applies to enabled symmetric customer managed keys whose
+# material KMS generated; AWS managed keys rotate on their own
+def is_rotatable_cmk(metadata):
+    return (
+        metadata['KeyManager'] == 'CUSTOMER'
+        and metadata['KeyState'] == 'Enabled'
+        and metadata.get('Origin') == 'AWS_KMS'
+        and metadata.get('KeySpec', 'SYMMETRIC_DEFAULT') == 'SYMMETRIC_DEFAULT'
+    )
+
+
+# keys are scanned concurrently, as many at a time as throttling allows;
+# every customer managed key is described once and only those get a rotation lookup
+@run_scoped
+def check_cmk_rotation(key_issues=None, region=REGION, workers=1):
+    key_issues = IssueStore() if key_issues is None else key_issues
+    keys = get_keys(region)
+
+    checked = scan_adaptive(
+        functools.partial(key_rotation_issues, key_issues=key_issues, region=region),
+        keys,
+        get_limiter('kms', region, workers),
+        lambda key, client_error: log_throttled(key['KeyArn'], client_error, key_issues))
+
+    LOGGER.info(f'{sum(map(bool, checked))} of {len(keys)} KMS keys customer managed for AWS acct {get_account()}')
+    return key_issues
+
+
+# returns whether the key is a customer managed key whose rotation was checked
+def key_rotation_issues(key, key_issues, region=REGION):
+    key_arn = key['KeyArn']
+
+    try:
+        if not is_rotatable_cmk(describe_key(key_arn, region)):
+            return False
+
+        rotation = cached_call(get_account(), get_client('kms', region), 'get_key_rotation_status', KeyId=key['KeyId'])
+
+    except ClientError as client_error:
+        # retried by scan_adaptive
+        if is_throttle(client_error):
+            raise
+
+        LOGGER.error(f'ClientError: {client_error}')
+        key_issues.add_exception(key_arn, f'ClientError: {client_error}')
+        return False
+
+    if not rotation['KeyRotationEnabled']:
+        LOGGER.warning(f'Key rotation is not enabled for {key_arn}')
+        key_issues.add(key_arn, '3.8')
+
+    return True
+
+
+# CIS 3.7: each trail's KmsKeyId has to name an enabled customer managed key;
+# multi-region trails are checked in their home region only
+@run_scoped
+def check_trail_encryption(trail_issues=None, region=REGION, workers=1):
+    trail_issues = IssueStore() if trail_issues is None else trail_issues
+    trails = home_trails(get_trails(region), region)
+
+    scan_adaptive(
+        functools.partial(trail_encryption_issues, trail_issues=trail_issues, region=region),
+        trails,
+        get_limiter('kms', region, workers),
+        lambda trail, client_error: log_throttled(trail['Name'], client_error, trail_issues))
+
+    return trail_issues
+
+
+def trail_encryption_issues(trail, trail_issues, region=REGION):
+    trail_name = trail['Name']
+    key_id = trail.get('KmsKeyId')
+
+    if key_id is None:
+        LOGGER.warning(f'Logs are not encrypted with a KMS CMK for {trail_name}')
+        trail_issues.add(trail_name, '3.7')
+        return
+
+    try:
+        metadata = describe_key(key_id, region)
+
+    except ClientError as client_error:
+        if is_throttle(client_error):
+            raise
+
+        LOGGER.error(f'ClientError: {client_error}')
+        trail_issues.add_exception(trail_name, f'ClientError: {client_error}')
+        return
+
+    if metadata['KeyManager'] != 'CUSTOMER' or metadata['KeyState'] != 'Enabled':
+        LOGGER.warning(f'{key_id} is not an enabled customer managed key for {trail_name}')
+        trail_issues.add(trail_name, '3.7', 1)
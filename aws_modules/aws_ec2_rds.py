@@ -5,7 +5,10 @@ $ aws ec2 get-ebs-encryption-by-default --region us-gov-west-1
 $ aws rds describe-db-instances --region us-gov-west-1 --query 'DBInstances[*].DBInstanceIdentifier'
 $ aws rds describe-db-instances --region us-gov-west-1 --db-instance-identifier <DB-Name> --query 'DBInstances[*].StorageEncrypted'
 '''
-import boto3
+from aws_modules.aws_session import REGION, get_account, get_client, run_scoped
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.concurrency import is_throttle
+from aws_modules.response_cache import cached_call
 
 from botocore.exceptions import ClientError
 
@@ -13,9 +16,70 @@ import logging
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger()
 
-REGION = 'us-gov-west-1'
+# one paginated sweep per region reads StorageEncrypted for every database,
+# instead of one describe-db-instances call per identifier:
+# aws rds describe-db-instances --region us-gov-west-1 --query 'DBInstances[*].[DBInstanceArn,StorageEncrypted]'
+# aws rds describe-db-clusters --region us-gov-west-1 --query 'DBClusters[*].[DBClusterArn,StorageEncrypted]'
+RDS_SWEEPS = (
+    ('describe_db_instances', 'DBInstances[].[DBInstanceArn, StorageEncrypted]'),
+    ('describe_db_clusters', 'DBClusters[].[DBClusterArn, StorageEncrypted]'),
+)
+
+
+# a region whose lookup failed is left unchecked, throttled ones are marked
+# the same way as throttled buckets and trails
+def log_region_error(region, client_error, issues):
+    msg = f'Throttled: {client_error}' if is_throttle(client_error) else f'ClientError: {client_error}'
+    LOGGER.error(f'{msg} for {region}')
+
+    issues.add_exception(region, msg)
+
+
+# aws ec2 get-ebs-encryption-by-default --region us-gov-west-1
+@run_scoped
+def check_ebs_encryption(ebs_issues=None, region=REGION):
+    ebs_issues = IssueStore() if ebs_issues is None else ebs_issues
+
+    try:
+        response = cached_call(get_account(), get_client('ec2', region), 'get_ebs_encryption_by_default')
+
+    except ClientError as client_error:
+        log_region_error(region, client_error, ebs_issues)
+        return ebs_issues
+
+    if not response['EbsEncryptionByDefault']:
+        LOGGER.warning(f'EBS encryption by default is not enabled in {region}')
+        ebs_issues.add(region, '2.2.1')
+
+    return ebs_issues
+
+
+# [arn, StorageEncrypted] for every DB instance, then every DB cluster
+def get_rds_storage_encryption(region=REGION):
+    rds_client = get_client('rds', region)
+
+    for operation, expression in RDS_SWEEPS:
+        yield from rds_client.get_paginator(operation).paginate().search(expression)
+
+
+@run_scoped
+def check_rds_encryption(rds_issues=None, region=REGION):
+    rds_issues = IssueStore() if rds_issues is None else rds_issues
+    databases = 0
+
+    try:
+        for arn, storage_encrypted in get_rds_storage_encryption(region):
+            databases += 1
+
+            if not storage_encrypted:
+                LOGGER.warning(f'Storage is not encrypted for {arn}')
+                rds_issues.add(arn, '2.3.1')
+
+    except ClientError as client_error:
+        log_region_error(region, client_error, rds_issues)
+
+    LOGGER.info(f'{databases} RDS instances and clusters in {region} for AWS acct {get_account()}')
+    return rds_issues
 
-STS_CLIENT = boto3.client('sts', region_name=REGION)
-AWS_ACCOUNT = STS_CLIENT.get_caller_identity().get('Account')
 
 # aws ec2 describe-route-tables --filter "Name=vpc-id,Values=<vpc_id>" --query "RouteTables[*].{RouteTableId:RouteTableId, VpcId:VpcId, Routes:Routes, AssociatedSubnets:Associations[*].SubnetId}"
@@ -0,0 +1,26 @@
+from botocore.awsrequest import AWSResponse
+
+# helpers for botocore event handlers registered on the shared session:
+# a before-call handler returning make_response(...) replaces the HTTP
+# request, and the client raises ClientError when the status is >= 300
+
+
+# before-parameter-build: keep the caller's API parameters for later events
+def capture_params(params, context, **kwargs):
+    context['api_params'] = dict(params)
+
+
+def api_params(context):
+    return context.get('api_params', {})
+
+
+def make_response(parsed, status_code=200):
+    return AWSResponse(None, status_code, {}, None), parsed
+
+
+def error_response(error_code, message='', status_code=400):
+    parsed = {
+        'Error': {'Code': error_code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status_code},
+    }
+    return make_response(parsed, status_code)
@@ -0,0 +1,71 @@
+from aws_modules.aws_cloudtrails import check_cloudtrail, check_cloudwatch_is_logging
+from aws_modules.aws_cmk import check_cmk_rotation, check_trail_encryption
+from aws_modules.aws_ec2_rds import check_ebs_encryption, check_rds_encryption
+from aws_modules.aws_s3 import (check_bucket_encryption, check_bucket_policy, check_bucket_public_access,
+                                check_bucket_versioning, get_region_buckets)
+from aws_modules.aws_session import get_client, memoise, run_scoped
+from aws_modules.concurrency import scan_concurrently
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+
+# aws ec2 describe-regions --filters Name=opt-in-status,Values=opt-in-not-required,opted-in
+def get_enabled_regions():
+    return memoise(
+        ('enabled_regions',),
+        lambda: sorted(region['RegionName'] for region in get_client('ec2').describe_regions(
+            Filters=[
+                {
+                    'Name': 'opt-in-status',
+                    'Values': ['opt-in-not-required', 'opted-in']
+                }
+            ]
+        )['Regions']))
+
+
+# run check(region) in every region concurrently, results keyed by region
+def run_in_regions(check, regions=None, workers=None):
+    regions = regions or get_enabled_regions()
+    results = scan_concurrently(check, regions, workers or len(regions))
+
+    return dict(zip(regions, results))
+
+
+@run_scoped
+def check_region(region, bucket_workers=1, all_buckets=False):
+    LOGGER.info(f'Checking {region}')
+
+    # S3 checks only cover the buckets homed in this region unless all_buckets;
+    # the buckets are split by region once and shared by the four checks
+    bucket_region = None if all_buckets else region
+    bucket_names = [bucket['Name'] for bucket in get_region_buckets(bucket_region, bucket_workers)]
+    bucket_issues = check_bucket_encryption(None, bucket_workers, bucket_region, bucket_names)
+    bucket_issues = check_bucket_policy(bucket_issues, bucket_workers, bucket_region, bucket_names)
+    bucket_issues = check_bucket_public_access(bucket_issues, bucket_workers, bucket_region, bucket_names)
+    bucket_issues = check_bucket_versioning(bucket_issues, bucket_workers, bucket_region, bucket_names)
+
+    trail_issues = check_cloudtrail(None, region, bucket_workers)
+    trail_issues = check_cloudwatch_is_logging(trail_issues, region, bucket_workers)
+    trail_issues = check_trail_encryption(trail_issues, region, bucket_workers)
+    key_issues = check_cmk_rotation(None, region, bucket_workers)
+
+    ebs_issues = check_ebs_encryption(None, region)
+    rds_issues = check_rds_encryption(None, region)
+
+    return {
+        's3': bucket_issues.to_dict(),
+        'cloudtrail': trail_issues.to_dict(),
+        'kms': key_issues.to_dict(),
+        'ebs': ebs_issues.to_dict(),
+        'rds': rds_issues.to_dict(),
+    }
+
+
+@run_scoped
+def check_all_regions(regions=None, workers=None, bucket_workers=1):
+    return run_in_regions(
+        lambda region: check_region(region, bucket_workers),
+        regions,
+        workers)
@@ -1,160 +1,271 @@
-import boto3
-import json
+import functools
 
-from aws_modules.cis_error_logger import cis_issue_logger
+from aws_modules.aws_session import REGION, forget, get_account, get_buckets, get_client, memoise, run_scoped
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.concurrency import get_limiter, is_throttle, scan_adaptive
+from aws_modules.response_cache import cached_call
+from aws_modules.s3_policies import compile_acl, get_policy_verdict
 
 from botocore.exceptions import ClientError
 import logging
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger()
 
-REGION = 'us-gov-west-1'
 
-STS_CLIENT = boto3.client('sts', region_name=REGION)
-AWS_ACCOUNT = STS_CLIENT.get_caller_identity().get('Account')
+# snapshot field -> (S3 API call, response parser); policies and ACLs are
+# kept as their verdicts, see s3_policies
+SNAPSHOT_FIELDS = {
+    'versioning': ('get_bucket_versioning', lambda response: response.get('Status')),
+    'encryption': ('get_bucket_encryption', lambda response: response['ServerSideEncryptionConfiguration']['Rules']),
+    'policy': ('get_bucket_policy', lambda response: get_policy_verdict(response['Policy'])),
+    'public_access_block': ('get_public_access_block', lambda response: response['PublicAccessBlockConfiguration']),
+    'acl': ('get_bucket_acl', lambda response: compile_acl(response['Grants'])),
+    'logging': ('get_bucket_logging', lambda response: response.get('LoggingEnabled')),
+}
+# fields the bucket checks read; logging is only looked up for trail buckets
+BUCKET_CHECK_FIELDS = ('versioning', 'encryption', 'policy', 'public_access_block', 'acl')
+
+
+# per-bucket config gathered once per run and shared by every check;
+# failed calls keep their ClientError/KeyError in errors
+class BucketSnapshot:
+    __slots__ = ('name', 'versioning', 'encryption', 'policy',
+                 'public_access_block', 'acl', 'logging', 'errors', 'fetched')
+
+    def __init__(self, name):
+        self.name = name
+        self.versioning = None
+        self.encryption = None
+        self.policy = None
+        self.public_access_block = None
+        self.acl = None
+        self.logging = None
+        self.errors = {}
+        self.fetched = set()
+
+
+def get_bucket_snapshot(bucket_name, fields=tuple(SNAPSHOT_FIELDS), region=REGION):
+    snapshot = memoise(('bucket_snapshot', bucket_name), lambda: BucketSnapshot(bucket_name))
+    s3_client = get_client('s3', region)
+    aws_account = get_account()
+
+    for field in fields:
+        if field in snapshot.fetched:
+            continue
+
+        api_call, parse = SNAPSHOT_FIELDS[field]
 
-S3_CLIENT = boto3.client("s3", region_name=REGION)
-BUCKETS = S3_CLIENT.list_buckets()['Buckets']
+        try:
+            response = cached_call(
+                aws_account, s3_client, api_call,
+                Bucket=bucket_name,
+                ExpectedBucketOwner=aws_account)
 
+            setattr(snapshot, field, parse(response))
 
-# aws s3api get-bucket-versioning --region us-gov-west-1 --bucket <bucket_name>
-def check_bucket_versioning(bucket_issues={}):
-    count = 0
+        except (KeyError, ClientError) as err:
+            # throttled fields stay unfetched, the caller retries the bucket
+            if is_throttle(err):
+                raise
+            snapshot.errors[field] = err
 
-    for bucket in BUCKETS:
-        bucket_name = bucket['Name']
+        snapshot.fetched.add(field)
 
-        try:
-            response = S3_CLIENT.get_bucket_versioning(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
+    return snapshot
 
-            if 'Status' not in response or response['Status'] != 'Enabled':
-                cis_id = "2.1.3"
-                msg = 'Versioning not enabled'
-                LOGGER.warning(f'{msg} for {bucket_name}')
 
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id)
+# still throttled after every retry: the error is kept on the unfetched
+# fields like any other failed call
+def snapshot_throttled(bucket_name, client_error, fields=tuple(SNAPSHOT_FIELDS), region=REGION):
+    snapshot = memoise(('bucket_snapshot', bucket_name), lambda: BucketSnapshot(bucket_name))
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
+    for field in fields:
+        if field not in snapshot.fetched:
+            snapshot.errors[field] = client_error
+            snapshot.fetched.add(field)
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+    return snapshot
 
-        count += 1
 
-    print(f'{count} BUCKETS for AWS acct {AWS_ACCOUNT}')
-    return bucket_issues
+# fetch the given fields for bucket_names in one concurrent pass
+def snapshot_bucket_names(bucket_names, fields=BUCKET_CHECK_FIELDS, workers=1, region=None):
+    return scan_adaptive(
+        functools.partial(get_bucket_snapshot, fields=fields, region=region or REGION),
+        bucket_names, get_limiter('s3', region, workers),
+        functools.partial(snapshot_throttled, fields=fields, region=region or REGION))
 
 
-# aws s3api get-bucket-encryption --region us-gov-west-1 --bucket <bucket_name>
-def check_bucket_encryption(bucket_issues={}):
-    count = 0
+# aws s3api get-bucket-location --bucket <bucket_name>
+def get_bucket_location(bucket_name):
+    response = cached_call(get_account(), get_client('s3'), 'get_bucket_location', Bucket=bucket_name)
+    # us-east-1 buckets report a null LocationConstraint
+    return response.get('LocationConstraint') or 'us-east-1'
 
-    for bucket in BUCKETS:
-        bucket_name = bucket['Name']
-        encryption_exists = False
 
-        try:
-            response = S3_CLIENT.get_bucket_encryption(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT
-            )
+# looked up once per run, whichever region's checks ask first
+def get_bucket_region(bucket):
+    if 'BucketRegion' in bucket:
+        return bucket['BucketRegion']
+
+    return memoise(('bucket_region', bucket['Name']), lambda: get_bucket_location(bucket['Name']))
+
+
+# buckets homed in region, or every bucket when region is None
+def get_region_buckets(region=None, workers=1):
+    buckets = get_buckets()
+
+    if region is None:
+        return buckets
+
+    bucket_regions = scan_adaptive(get_bucket_region, buckets, get_limiter('s3', region, workers))
+    return [bucket for bucket, bucket_region in zip(buckets, bucket_regions) if bucket_region == region]
 
-            for rule in response['ServerSideEncryptionConfiguration']['Rules']:
 
-                if(rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'] == 'AES256'):
-                    encryption_exists = True
-                    # encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
-                    # msg = f'encryption: {encryption}'
-                    # LOGGER.info(msg)
-                    break
+# still throttled after every retry: the bucket is left unchecked, not dropped silently
+def log_throttled(bucket_name, client_error, bucket_issues=None):
+    msg = f'Throttled: {client_error}'
+    LOGGER.error(f'{msg} for {bucket_name}')
 
-                if(rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'] == 'aws:kms'):
-                    encryption_exists = True
-                    # encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
-                    # msg = f'encryption: {encryption}'
-                    # LOGGER.info(msg)
-                    break
+    if bucket_issues is not None:
+        bucket_issues.add_exception(bucket_name, msg)
 
-            cis_id = "2.1.1"
-            if(not encryption_exists):
-                encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
-                msg = f'Incorrect server side encryption ({encryption})'
-                LOGGER.warning(f'{msg} for {bucket_name}')
 
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id)
+def snapshot_error_code(snapshot, field):
+    error = snapshot.errors.get(field)
 
-        except S3_CLIENT.exceptions.from_code('ServerSideEncryptionConfigurationNotFoundError'):
-            msg = 'NO server side encryption config'
-            LOGGER.error(f'{msg} for {bucket_name}')
+    if isinstance(error, ClientError):
+        return error.response['Error']['Code']
 
-            bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id, 1)
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
+def log_snapshot_errors(snapshot, fields):
+    logged = False
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+    for field in fields:
+        error = snapshot.errors.get(field)
 
-        count += 1
+        if isinstance(error, KeyError):
+            msg = f"No such key {error} found"
+            LOGGER.error(f'{msg} for {snapshot.name}')
+            logged = True
 
-    print(f'{count} BUCKETS for AWS acct {AWS_ACCOUNT}')
+        elif error is not None:
+            LOGGER.error(f'ClientError: {error}')
+            logged = True
+
+    return logged
+
+
+# buckets are scanned on a shared client, up to workers at a time as
+# throttling allows, and the per-bucket findings appended to one shared
+# IssueStore; bucket_names narrows the scan to a subset of the buckets
+def scan_buckets(scan_bucket, bucket_issues=None, workers=1, region=None, bucket_names=None, on_exhausted=log_throttled):
+    bucket_issues = IssueStore() if bucket_issues is None else bucket_issues
+    if bucket_names is None:
+        bucket_names = [bucket['Name'] for bucket in get_region_buckets(region, workers)]
+    scan_bucket = functools.partial(scan_bucket, bucket_issues=bucket_issues, region=region or REGION)
+    on_exhausted = functools.partial(on_exhausted, bucket_issues=bucket_issues)
+
+    scan_adaptive(scan_bucket, bucket_names, get_limiter('s3', region, workers), on_exhausted)
+
+    LOGGER.info(f'{len(bucket_names)} BUCKETS for AWS acct {get_account()}')
     return bucket_issues
 
 
-# aws s3api get-bucket-policy --region us-gov-west-1 --bucket <bucket_name> | grep aws:SecureTransport
-def check_bucket_policy(bucket_issues={}):
-    count = 0
+# aws s3api get-bucket-versioning --region us-gov-west-1 --bucket <bucket_name>
+@run_scoped
+def check_bucket_versioning(bucket_issues=None, workers=1, region=None, bucket_names=None):
+    return scan_buckets(bucket_versioning_issues, bucket_issues, workers, region, bucket_names)
 
-    for bucket in BUCKETS:
-        bucket_name = bucket['Name']
-        ssl_key_exists = False
 
-        try:
-            response = S3_CLIENT.get_bucket_policy(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
+def bucket_versioning_issues(bucket_name, bucket_issues, region=REGION):
+    snapshot = get_bucket_snapshot(bucket_name, ('versioning',), region)
 
-            policy_json = json.loads(response['Policy'])
+    if log_snapshot_errors(snapshot, ('versioning',)):
+        return
 
-            for statement in policy_json['Statement']:
-                if 'Condition' in statement.keys() and 'Bool' in statement['Condition'].keys():
-                    if statement['Condition']['Bool']['aws:SecureTransport'] == 'false':
-                        ssl_key_exists = True
-                        # LOGGER.info(f'SSL enforced for {bucket_name}')
-                        break
+    if snapshot.versioning != 'Enabled':
+        cis_id = "2.1.3"
+        msg = 'Versioning not enabled'
+        LOGGER.warning(f'{msg} for {bucket_name}')
 
-            if(not ssl_key_exists):
-                cis_id = "2.1.2"
-                msg = 'SSL NOT enforced'
-                LOGGER.warning(f'{msg} for {bucket_name}')
+        bucket_issues.add(bucket_name, cis_id)
 
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id)
 
-        except S3_CLIENT.exceptions.from_code('NoSuchBucketPolicy'):
-            msg = 'NO Bucket Policy'
-            LOGGER.error(f'{msg} for {bucket_name}')
+# aws s3api get-bucket-encryption --region us-gov-west-1 --bucket <bucket_name>
+@run_scoped
+def check_bucket_encryption(bucket_issues=None, workers=1, region=None, bucket_names=None):
+    return scan_buckets(bucket_encryption_issues, bucket_issues, workers, region, bucket_names)
 
-            if bucket_name not in bucket_issues.keys():
-                bucket_issues[bucket_name] = {}
-            if msg not in bucket_issues[bucket_name].values():
-                bucket_issues[bucket_name].update({'exception': msg})
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
+def bucket_encryption_issues(bucket_name, bucket_issues, region=REGION):
+    encryption_exists = False
+    cis_id = "2.1.1"
+    snapshot = get_bucket_snapshot(bucket_name, ('encryption',), region)
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+    if snapshot_error_code(snapshot, 'encryption') == 'ServerSideEncryptionConfigurationNotFoundError':
+        msg = 'NO server side encryption config'
+        LOGGER.error(f'{msg} for {bucket_name}')
 
-        count += 1
+        bucket_issues.add(bucket_name, cis_id, 1)
+        return
 
-    print(f'{count} BUCKETS for AWS acct {AWS_ACCOUNT}')
-    return bucket_issues
+    if log_snapshot_errors(snapshot, ('encryption',)):
+        return
+
+    try:
+        for rule in snapshot.encryption:
+
+            if(rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'] == 'AES256'):
+                encryption_exists = True
+                # encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
+                # msg = f'encryption: {encryption}'
+                # LOGGER.info(msg)
+                break
+
+            if(rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'] == 'aws:kms'):
+                encryption_exists = True
+                # encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
+                # msg = f'encryption: {encryption}'
+                # LOGGER.info(msg)
+                break
+
+        if(not encryption_exists):
+            encryption = rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
+            msg = f'Incorrect server side encryption ({encryption})'
+            LOGGER.warning(f'{msg} for {bucket_name}')
+
+            bucket_issues.add(bucket_name, cis_id)
+
+    except KeyError as key_err:
+        msg = f"No such key {key_err} found"
+        LOGGER.error(f'{msg} for {bucket_name}')
+
+
+# aws s3api get-bucket-policy --region us-gov-west-1 --bucket <bucket_name> | grep aws:SecureTransport
+@run_scoped
+def check_bucket_policy(bucket_issues=None, workers=1, region=None, bucket_names=None):
+    return scan_buckets(bucket_policy_issues, bucket_issues, workers, region, bucket_names)
+
+
+def bucket_policy_issues(bucket_name, bucket_issues, region=REGION):
+    snapshot = get_bucket_snapshot(bucket_name, ('policy',), region)
+
+    if snapshot_error_code(snapshot, 'policy') == 'NoSuchBucketPolicy':
+        msg = 'NO Bucket Policy'
+        LOGGER.error(f'{msg} for {bucket_name}')
+
+        bucket_issues.add_exception(bucket_name, msg)
+        return
+
+    if log_snapshot_errors(snapshot, ('policy',)):
+        return
+
+    if(not snapshot.policy.enforces_ssl):
+        cis_id = "2.1.2"
+        msg = 'SSL NOT enforced'
+        LOGGER.warning(f'{msg} for {bucket_name}')
+
+        bucket_issues.add(bucket_name, cis_id)
 
 
 # 2.1.5, 3.3
@@ -162,107 +273,96 @@ def check_bucket_policy(bucket_issues={}):
 # $ aws s3api get-bucket-policy --bucket <bucket_name>
 
 # aws s3api get-public-access-block --region us-gov-west-1 --bucket <bucket_name>
-def check_bucket_public_access(bucket_issues={}):
-    count = 0
+@run_scoped
+def check_bucket_public_access(bucket_issues=None, workers=1, region=None, bucket_names=None):
+    return scan_buckets(bucket_public_access_issues, bucket_issues, workers, region, bucket_names)
 
-    for bucket in BUCKETS:
-        bucket_name = bucket['Name']
-        public_access_block_exists = False
-        restricted_alluser_acl_exists = False
-        restricted_privuser_acl_exists = False
-        restricted_anonymous_access_exists = False
 
-        # Public Access Block Configuration
-        try:
-            # aws s3api get-bucket-acl --region us-gov-west-1 --bucket <bucket_name>
-            pab_response = S3_CLIENT.get_public_access_block(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
+def bucket_public_access_issues(bucket_name, bucket_issues, region=REGION):
+    public_access_block_exists = False
+    restricted_alluser_acl_exists = False
+    restricted_privuser_acl_exists = False
+    restricted_anonymous_access_exists = False
+    snapshot = get_bucket_snapshot(bucket_name, ('public_access_block', 'acl', 'policy'), region)
 
-            if pab_response['PublicAccessBlockConfiguration']:
-                public_access_block_exists = True
-                # msg = f'{bucket_name} has {pab_response["PublicAccessBlockConfiguration"]}'
-                # LOGGER.info(msg)
-                break
+    # Public Access Block Configuration
+    if snapshot_error_code(snapshot, 'public_access_block') == 'NoSuchPublicAccessBlockConfiguration':
+        msg = 'NO public access block configuration'
+        LOGGER.error(f'{msg} for {bucket_name}')
 
-        except S3_CLIENT.exceptions.from_code('NoSuchPublicAccessBlockConfiguration'):
-            msg = 'NO public access block configuration'
-            LOGGER.error(f'{msg} for {bucket_name}')
+    elif not log_snapshot_errors(snapshot, ('public_access_block',)):
+        if snapshot.public_access_block:
+            public_access_block_exists = True
+            # msg = f'{bucket_name} has {snapshot.public_access_block}'
+            # LOGGER.info(msg)
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
+    # Access Control List restricting Public Access
+    # $ aws s3api get-bucket-acl --bucket <bucket_name> --query 'Grants[?Grantee.URI== `http://acs.amazonaws.com/groups/global/AllUsers` ]'
+    # $ aws s3api get-bucket-acl --bucket <bucket_name> --query 'Grants[?Grantee.URI== `http://acs.amazonaws.com/groups/global/AuthenticatedUsers` ]'
+    if not log_snapshot_errors(snapshot, ('acl',)):
+        restricted_alluser_acl_exists = not snapshot.acl.all_users
+        restricted_privuser_acl_exists = not snapshot.acl.authenticated_users
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+    # Bucket policy dis-allowing Anonymous User Access; no policy allows no one
+    if snapshot_error_code(snapshot, 'policy') == 'NoSuchBucketPolicy':
+        msg = 'No bucket policy'
+        LOGGER.error(f'{msg} for {bucket_name}')
 
-        # Access Control List restricting Public Access
-        try:
-            acl_response = S3_CLIENT.get_bucket_acl(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
+        bucket_issues.add_exception(bucket_name, msg)
+        restricted_anonymous_access_exists = True
 
-            # $ aws s3api get-bucket-acl --bucket <bucket_name> --query 'Grants[?Grantee.URI== `http://acs.amazonaws.com/groups/global/AllUsers` ]'
-            # $ aws s3api get-bucket-acl --bucket <bucket_name> --query 'Grants[?Grantee.URI== `http://acs.amazonaws.com/groups/global/AuthenticatedUsers` ]'
-            # FIXME if URI for s3 logging exists, http://acs.amazonaws.com/groups/s3/LogDelivery, Anonymous User access logic is skipped?
-            # possibly separate try/except blocks for policy_response
-            for grant in acl_response['Grants']:
-                if 'http://acs.amazonaws.com/groups/global/AllUsers' not in grant['Grantee'].values():
-                    restricted_alluser_acl_exists = True
+    elif not log_snapshot_errors(snapshot, ('policy',)):
+        restricted_anonymous_access_exists = not snapshot.policy.allows_anonymous
 
-                if 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers' not in grant['Grantee'].values():
-                    restricted_privuser_acl_exists = True
+    # Final LOGIC
+    if(public_access_block_exists or (restricted_alluser_acl_exists and restricted_privuser_acl_exists and restricted_anonymous_access_exists)):
+        msg = "Public Access blocked"
+        # LOGGER.info(f'{msg} for {bucket_name}')
 
-            # Bucket policy dis-allowing Anonymous User Access
-            policy_response = S3_CLIENT.get_bucket_policy(
-                Bucket=bucket_name,
-                ExpectedBucketOwner=AWS_ACCOUNT)
+    else:
+        cis_id = "2.1.5"
 
-            policy_json = json.loads(policy_response['Policy'])
+        # TODO DRY refactor
+        if(not public_access_block_exists):
+            bucket_issues.add(bucket_name, cis_id)
 
-            for policy in policy_json['Statement']:
-                if(not (policy['Effect'] == 'Allow' and policy['Principal'] == '*')):
-                    restricted_anonymous_access_exists = True
+        if(not restricted_alluser_acl_exists):
+            bucket_issues.add(bucket_name, cis_id, 1)
 
-        except S3_CLIENT.exceptions.from_code('NoSuchBucketPolicy'):
-            msg = 'No bucket policy'
-            LOGGER.error(f'{msg} for {bucket_name}')
+        if(not restricted_privuser_acl_exists):
+            bucket_issues.add(bucket_name, cis_id, 2)
 
-            if bucket_name not in bucket_issues.keys():
-                bucket_issues[bucket_name] = {}
-            if msg not in bucket_issues[bucket_name].values():
-                bucket_issues[bucket_name].update({'exception': msg})
+        if(not restricted_anonymous_access_exists):
+            bucket_issues.add(bucket_name, cis_id, 3)
 
-        except KeyError as key_err:
-            msg = f"No such key {key_err} found"
-            LOGGER.error(f'{msg} for {bucket_name}')
 
-        except ClientError as client_error:
-            LOGGER.error(f'ClientError: {client_error}')
+# every bucket check in one pass, each bucket's snapshot and dedup keys
+# dropped as soon as its checks have run, so a streamed run only holds
+# the buckets in flight
+@run_scoped
+def check_bucket_suite(bucket_issues=None, workers=1, region=None, bucket_names=None):
+    return scan_buckets(bucket_suite_issues, bucket_issues, workers, region, bucket_names, suite_throttled)
 
-        # Final LOGIC
-        if(public_access_block_exists or (restricted_alluser_acl_exists and restricted_privuser_acl_exists and restricted_anonymous_access_exists)):
-            msg = "Public Access blocked"
-            # LOGGER.info(f'{msg} for {bucket_name}')
-            count += 1
 
-        else:
-            cis_id = "2.1.5"
+def bucket_suite_issues(bucket_name, bucket_issues, region=REGION):
+    # throttled fields are retried by scan_adaptive before any check runs
+    get_bucket_snapshot(bucket_name, BUCKET_CHECK_FIELDS, region)
 
-            # TODO DRY refactor
-            if(not public_access_block_exists):
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id)
+    try:
+        bucket_encryption_issues(bucket_name, bucket_issues, region)
+        bucket_policy_issues(bucket_name, bucket_issues, region)
+        bucket_public_access_issues(bucket_name, bucket_issues, region)
+        bucket_versioning_issues(bucket_name, bucket_issues, region)
 
-            if(not restricted_alluser_acl_exists):
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id, 1)
+    finally:
+        forget_bucket(bucket_name, bucket_issues)
 
-            if(not restricted_privuser_acl_exists):
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id, 2)
 
-            if(not restricted_anonymous_access_exists):
-                bucket_issues = cis_issue_logger(bucket_name, bucket_issues, cis_id, 3)
+def suite_throttled(bucket_name, client_error, bucket_issues):
+    log_throttled(bucket_name, client_error, bucket_issues)
+    forget_bucket(bucket_name, bucket_issues)
 
-            count += 1
 
-    print(f'{count} BUCKETS for AWS acct {AWS_ACCOUNT}')
-    return bucket_issues
+def forget_bucket(bucket_name, bucket_issues):
+    forget(('bucket_snapshot', bucket_name))
+    bucket_issues.forget(bucket_name)
@@ -0,0 +1,190 @@
+import asyncio
+import boto3
+import contextlib
+import functools
+import threading
+from botocore.config import Config
+
+from aws_modules.response_cache import cached_call
+
+REGION = 'us-gov-west-1'
+# list_buckets only returns each bucket's BucketRegion when paged, up to 10000 a page
+BUCKET_PAGE_SIZE = 10000
+# botocore's default pool, raised to the worker count by configure_clients
+MAX_POOL_CONNECTIONS = 10
+# attempts botocore makes per call, the first included; throttles that
+# outlast them are retried by run_adaptive and DeletionExecutor, which count
+# these attempts against their own MAX_ATTEMPTS
+CLIENT_MAX_ATTEMPTS = 3
+
+# one session per run; clients and inventories are created on first use
+# and shared by every module
+_LOCK = threading.RLock()
+_SESSION = None
+_CLIENTS = {}
+_RESOURCES = {}
+_MEMO = {}
+# key -> lock held while that key is fetched
+_MEMO_LOCKS = {}
+# checks currently running; the memo lasts as long as the outermost one
+_RUNS = 0
+
+
+# adaptive retries back off on throttling client-side, keep-alive stops idle
+# pooled connections being dropped between bursts of calls
+def client_config(max_pool_connections=MAX_POOL_CONNECTIONS):
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={'mode': 'adaptive', 'max_attempts': CLIENT_MAX_ATTEMPTS},
+        tcp_keepalive=True)
+
+
+_CONFIG = client_config()
+
+
+def get_session():
+    global _SESSION
+
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session()
+        return _SESSION
+
+
+def set_session(session):
+    global _SESSION
+
+    with _LOCK:
+        _SESSION = session
+        _CLIENTS.clear()
+        _RESOURCES.clear()
+        _MEMO.clear()
+        _MEMO_LOCKS.clear()
+
+
+# one pooled connection per worker, so parallel checks never queue for one
+def configure_clients(workers=1):
+    global _CONFIG
+
+    with _LOCK:
+        _CONFIG = client_config(max(MAX_POOL_CONNECTIONS, workers))
+        _CLIENTS.clear()
+        _RESOURCES.clear()
+
+
+def get_client(service, region=REGION):
+    key = (service, region)
+
+    with _LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = get_session().client(service, region_name=region, config=_CONFIG)
+        return _CLIENTS[key]
+
+
+def get_resource(service, region=REGION):
+    key = (service, region)
+
+    with _LOCK:
+        if key not in _RESOURCES:
+            _RESOURCES[key] = get_session().resource(service, region_name=region, config=_CONFIG)
+        return _RESOURCES[key]
+
+
+# fetched under the key's own lock, so a slow call only holds up callers
+# of the same key; values fetched across a set_session are not kept
+def memoise(key, fetch):
+    with _LOCK:
+        if key in _MEMO:
+            return _MEMO[key]
+        key_lock = _MEMO_LOCKS.setdefault(key, threading.RLock())
+
+    with key_lock:
+        with _LOCK:
+            if key in _MEMO:
+                return _MEMO[key]
+
+        value = fetch()
+
+        with _LOCK:
+            if _MEMO_LOCKS.get(key) is key_lock:
+                _MEMO[key] = value
+                del _MEMO_LOCKS[key]
+
+        return value
+
+
+# drops a value before the run ends, once its last reader is done with it
+def forget(key):
+    with _LOCK:
+        _MEMO.pop(key, None)
+
+
+# each top-level check opens a run and nested or concurrent checks join the
+# one already open; once the last one ends the run's inventories and
+# snapshots are dropped, so a long-running process never answers a new
+# audit from an earlier one
+@contextlib.contextmanager
+def audit_run():
+    global _RUNS
+
+    with _LOCK:
+        _RUNS += 1
+
+    try:
+        yield
+
+    finally:
+        with _LOCK:
+            _RUNS -= 1
+            if _RUNS == 0:
+                _MEMO.clear()
+                _MEMO_LOCKS.clear()
+
+
+# decorator form of audit_run for sync and async checks
+def run_scoped(check):
+    if asyncio.iscoroutinefunction(check):
+        @functools.wraps(check)
+        async def run_async(*args, **kwargs):
+            with audit_run():
+                return await check(*args, **kwargs)
+
+        return run_async
+
+    @functools.wraps(check)
+    def run(*args, **kwargs):
+        with audit_run():
+            return check(*args, **kwargs)
+
+    return run
+
+
+def get_account():
+    return memoise(
+        ('account',),
+        lambda: get_client('sts').get_caller_identity().get('Account'))
+
+
+# aws s3api list-buckets --max-buckets 10000
+def list_all_buckets():
+    s3_client = get_client('s3')
+    params = {'MaxBuckets': BUCKET_PAGE_SIZE}
+    buckets = []
+
+    while True:
+        response = cached_call(get_account(), s3_client, 'list_buckets', **params)
+        buckets.extend(response['Buckets'])
+
+        if not response.get('ContinuationToken'):
+            return buckets
+        params['ContinuationToken'] = response['ContinuationToken']
+
+
+def get_buckets():
+    return memoise(('buckets',), list_all_buckets)
+
+
+def get_trails(region=REGION):
+    return memoise(
+        ('trails', region),
+        lambda: cached_call(get_account(), get_client('cloudtrail', region), 'describe_trails')['trailList'])
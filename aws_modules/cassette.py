@@ -0,0 +1,128 @@
+import copy
+import gzip
+import json
+import threading
+import time
+from collections import Counter
+
+import boto3
+
+from aws_modules.aws_events import api_params, capture_params, make_response
+from aws_modules.aws_session import REGION, set_session
+from aws_modules.response_cache import decode_response, encode_response
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+# record every botocore call made through the shared session into a
+# gzipped cassette, then serve the same answers offline:
+#   python main.py --record audit.cassette.gz
+#   python main.py --replay audit.cassette.gz --replay-latency 0.05
+CASSETTE_VERSION = 1
+
+
+# calls are matched on region, service, operation and the caller's own
+# parameters; paginated calls differ by their token
+def interaction_key(model, context):
+    return json.dumps(
+        [context.get('client_region'), model.service_model.service_name, model.name, api_params(context)],
+        sort_keys=True, default=str, separators=(',', ':'))
+
+
+class Cassette:
+    def __init__(self, interactions=None, latency=0):
+        # key -> [[status code, parsed response], ...] in the order they were made
+        self.interactions = interactions or {}
+        self.latency = latency
+        self._played = Counter()
+        self._lock = threading.Lock()
+
+    # after-call: fires for error responses too, after botocore's own retries
+    def record(self, http_response, parsed, model, context, **kwargs):
+        key = interaction_key(model, context)
+        # callers own the parsed response and may change it
+        parsed = copy.deepcopy(parsed)
+
+        with self._lock:
+            self.interactions.setdefault(key, []).append([http_response.status_code, parsed])
+
+    # before-call: answers from the cassette, the request never goes out;
+    # repeated calls get the recorded answers in order, then the last one
+    def play(self, model, context, **kwargs):
+        key = interaction_key(model, context)
+
+        with self._lock:
+            responses = self.interactions.get(key)
+            if not responses:
+                raise LookupError(f"no recorded response for {key[:500]}")
+
+            index = min(self._played[key], len(responses) - 1)
+            self._played[key] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        status_code, parsed = responses[index]
+        # callers pop ResponseMetadata, keep the recorded copy whole
+        return make_response(dict(parsed), status_code)
+
+    # the caller's parameters are kept before botocore injects its own,
+    # such as idempotency tokens, so keys match between runs
+    def recorder(self, session=None):
+        session = session or boto3.session.Session()
+        session.events.register_first('before-parameter-build.*.*', capture_params)
+        session.events.register('after-call.*.*', self.record)
+        return session
+
+    def player(self, session=None):
+        # nothing is signed or sent, any credentials will do
+        session = session or boto3.session.Session(
+            aws_access_key_id='replay',
+            aws_secret_access_key='replay',
+            region_name=REGION)
+        session.events.register_first('before-parameter-build.*.*', capture_params)
+        session.events.register('before-call.*.*', self.play)
+        return session
+
+    def save(self, path):
+        with self._lock:
+            body = encode_response({'version': CASSETTE_VERSION, 'interactions': self.interactions})
+
+        with gzip.open(path, 'wt') as cassette_file:
+            cassette_file.write(body)
+
+        LOGGER.info(f"recorded {len(self.interactions)} distinct calls to {path}")
+
+    @classmethod
+    def load(cls, path, latency=0):
+        with gzip.open(path, 'rt') as cassette_file:
+            cassette = decode_response(cassette_file.read())
+
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"{path} is not a version {CASSETTE_VERSION} cassette")
+
+        return cls(cassette['interactions'], latency)
+
+
+# every module's clients come from the shared session, so swapping it
+# is enough to record or replay a whole run
+def start_recording():
+    cassette = Cassette()
+    set_session(cassette.recorder())
+    return cassette
+
+
+def start_replay(path, latency=0):
+    cassette = Cassette.load(path, latency)
+    set_session(cassette.player())
+    return cassette
+
+
+def add_cassette_args(parser):
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help='record every AWS call of this run to a cassette at PATH')
+    parser.add_argument('--replay', default=None, metavar='PATH',
+                        help='answer AWS calls from the cassette at PATH instead of AWS')
+    parser.add_argument('--replay-latency', type=float, default=0, metavar='SECONDS',
+                        help='delay added to every replayed call')
@@ -1,3 +1,7 @@
+import sys
+import threading
+from collections import Counter
+
 cis_dict = {
     "2.1.1": [
         "Incorrect server side encryption",
@@ -11,23 +15,147 @@ cis_dict = {
         "AuthenticatedUsers access",
         "Anonymous user access"
     ],
+    "2.2.1": ["EBS encryption by default not enabled"],
+    "2.3.1": ["RDS storage not encrypted"],
     "3.1": ["Multi-region is not enabled for any trails"],
     "3.2": ["Logfile validation is not enabled"],
     "3.4": ["CloudWatch is not being logged"],
-    "3.6": ["Logging not enabled"]
+    "3.6": ["Logging not enabled"],
+    "3.7": [
+        "Logs not encrypted with a KMS CMK",
+        "KMS key is not an enabled customer managed key"
+    ],
+    "3.8": ["CMK rotation not enabled"]
 }
 
 
-def cis_issue_logger(item, issues, cis_id, index=0):
-    msg = cis_dict[cis_id][index]
+# findings keyed by item (bucket, trail, ...) then CIS ID; messages are
+# kept as indexes into cis_dict and resolved only when viewed, and every
+# append goes through one lock so parallel scanners can share a store.
+# With a sink each new finding is also streamed out as it is added, and
+# retain=False drops the findings themselves, keeping the counts and the
+# keys seen for items still being checked, so a streamed run skips the
+# same duplicates and reports the same counts as a retained one.
+class IssueStore:
+    def __init__(self, sink=None, retain=True):
+        self.sink = sink
+        self.retain = retain
+        self._lock = threading.Lock()
+        self._findings = {}
+        self._exceptions = {}
+        self._exception_count = 0
+        # item -> (cis_id, index) keys already added
+        self._seen = {}
+        self._cis_counts = Counter()
+
+    def add(self, item, cis_id, index=0):
+        cis_id = sys.intern(cis_id)
+        key = (cis_id, index)
+
+        with self._lock:
+            seen = self._seen.setdefault(item, set())
+            if key in seen:
+                return False
+
+            seen.add(key)
+            if self.retain:
+                self._findings.setdefault(item, {}).setdefault(cis_id, []).append(index)
+            self._cis_counts[cis_id] += 1
+
+        if self.sink is not None:
+            self.sink.finding(item, cis_id, cis_dict[cis_id][index])
+
+        return True
+
+    # once every check on item has run its keys can go; a retained store
+    # keeps them alongside the findings they dedupe
+    def forget(self, item):
+        if self.retain:
+            return
+
+        with self._lock:
+            self._seen.pop(item, None)
+
+    # API errors that stopped a check, one per item, latest wins
+    def add_exception(self, item, msg):
+        with self._lock:
+            if self.retain:
+                self._findings.setdefault(item, {})
+                self._exceptions[item] = msg
+            self._exception_count += 1
+
+        if self.sink is not None:
+            self.sink.exception(item, msg)
+
+    def merge(self, other):
+        for item, cis_id, index in other.findings():
+            self.add(item, cis_id, index)
+
+        for item, msg in other.exceptions().items():
+            self.add_exception(item, msg)
+
+        return self
+
+    def findings(self):
+        with self._lock:
+            return [
+                (item, cis_id, index)
+                for item, item_findings in self._findings.items()
+                for cis_id, indexes in item_findings.items()
+                for index in indexes
+            ]
+
+    def exceptions(self):
+        with self._lock:
+            return dict(self._exceptions)
+
+    def items(self):
+        with self._lock:
+            return list(self._findings)
+
+    def count(self, cis_id=None):
+        with self._lock:
+            if cis_id is None:
+                return sum(self._cis_counts.values())
+            return self._cis_counts[cis_id]
+
+    def exception_count(self):
+        with self._lock:
+            return self._exception_count
+
+    def count_by_cis(self):
+        with self._lock:
+            return dict(self._cis_counts)
+
+    def group_by_cis(self):
+        groups = {}
+
+        for item, cis_id, index in self.findings():
+            items = groups.setdefault(cis_id, [])
+            if not items or items[-1] != item:
+                items.append(item)
+
+        return groups
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, item):
+        with self._lock:
+            return item in self._findings
 
-    if item not in issues.keys():
-        issues[item] = {}
+    # compatibility view: {item: {cis_id: [msg, ...], 'exception': msg}}
+    def to_dict(self):
+        with self._lock:
+            issues = {}
 
-    if cis_id not in issues[item].keys():
-        issues[item].update({cis_id: []})
+            for item, item_findings in self._findings.items():
+                issues[item] = {
+                    cis_id: [cis_dict[cis_id][index] for index in indexes]
+                    for cis_id, indexes in item_findings.items()
+                }
 
-    if msg not in issues[item][cis_id]:
-        issues[item][cis_id].append(msg)
+                if item in self._exceptions:
+                    issues[item]['exception'] = self._exceptions[item]
 
-    return issues
+            return issues
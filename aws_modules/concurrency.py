@@ -0,0 +1,218 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_modules.aws_session import memoise
+
+from botocore.exceptions import ClientError
+
+# error codes AWS answers with when a caller is going too fast
+THROTTLE_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+}
+
+# HTTP attempts per item, botocore's own retries included
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+
+
+# run scan_item over items on a bounded thread pool, results kept in input order
+def scan_concurrently(scan_item, items, workers=1):
+    if workers <= 1:
+        return [scan_item(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_item, items))
+
+
+# adaptive counterpart: at most limiter.limit items in flight, throttled
+# items retried after a backoff instead of dropped
+def scan_adaptive(scan_item, items, limiter, on_exhausted=None):
+    def run(item):
+        return run_adaptive(scan_item, item, limiter, on_exhausted)
+
+    with ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        return list(executor.map(run, items))
+
+
+# asyncio counterpart: blocking scan_item calls run on a pool of limit
+# threads of its own, never the loop's default executor, with at most limit
+# in flight; results kept in input order
+async def gather_limited(scan_item, items, limit=10, limiter=None, on_exhausted=None):
+    semaphore = asyncio.Semaphore(limit)
+    limiter = limiter or AdaptiveLimiter(limit)
+    executor = ThreadPoolExecutor(max_workers=limit)
+
+    async def run(item):
+        async with semaphore:
+            return await run_adaptive_async(scan_item, item, limiter, on_exhausted, executor)
+
+    try:
+        return await asyncio.gather(*(run(item) for item in items))
+
+    finally:
+        executor.shutdown(wait=False)
+
+
+# blocks callers so that on average no more than rate calls per second go
+# out, with bursts of up to capacity
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLE_CODES
+
+
+# HTTP attempts behind a ClientError, botocore's retries included
+def call_attempts(client_error):
+    return 1 + client_error.response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+
+# full jitter keeps throttled workers from retrying in step
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# additive increase, multiplicative decrease: the in-flight limit grows by
+# about one per round of calls answered without throttling at normal
+# latency, and is cut by backoff_factor on a throttle
+class AdaptiveLimiter:
+    def __init__(self, maximum, minimum=1, initial=None, backoff_factor=0.5, latency_factor=3.0):
+        self.maximum = max(1, maximum)
+        self.minimum = min(minimum, self.maximum)
+        self.limit = float(initial or max(self.minimum, self.maximum // 4))
+        self.backoff_factor = backoff_factor
+        self.latency_factor = latency_factor
+        self.latency = None
+        self._in_flight = 0
+        self._last_cut = time.monotonic()
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+
+            self._in_flight += 1
+
+        return time.monotonic()
+
+    def release(self, started, throttled=False):
+        now = time.monotonic()
+        latency = now - started
+
+        with self._condition:
+            self._in_flight -= 1
+
+            if throttled:
+                # calls already in flight at the last cut were sent at the
+                # old limit, their throttles don't cut it again
+                if started >= self._last_cut:
+                    self.limit = max(self.minimum, self.limit * self.backoff_factor)
+                    self._last_cut = now
+
+            else:
+                # slow answers are an early sign of throttling, stop growing
+                if self.latency is None or latency <= self.latency * self.latency_factor:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+
+            self._condition.notify_all()
+
+
+# one limiter per service and region for the run, so what one check
+# learned about the throttling limit carries over to the next
+def get_limiter(service, region, workers):
+    return memoise(('limiter', service, region, workers), lambda: AdaptiveLimiter(workers))
+
+
+# one item under the limiter; on_exhausted(item, error) gives the result
+# for an item still throttled after MAX_ATTEMPTS, otherwise the error is raised
+def run_adaptive(scan_item, item, limiter, on_exhausted=None):
+    attempts = 0
+
+    while True:
+        started = limiter.acquire()
+        throttled = False
+
+        try:
+            return scan_item(item)
+
+        except ClientError as client_error:
+            if not is_throttle(client_error):
+                raise
+
+            throttled = True
+            attempts += call_attempts(client_error)
+            if attempts >= MAX_ATTEMPTS:
+                if on_exhausted is None:
+                    raise
+                return on_exhausted(item, client_error)
+
+        finally:
+            limiter.release(started, throttled)
+
+        time.sleep(backoff_delay(attempts))
+
+
+# run_adaptive for the event loop: limiter waits and calls take a thread of
+# executor, backoffs are slept on the loop without holding one
+async def run_adaptive_async(scan_item, item, limiter, on_exhausted=None, executor=None):
+    loop = asyncio.get_running_loop()
+    attempts = 0
+
+    while True:
+        started = await loop.run_in_executor(executor, limiter.acquire)
+        throttled = False
+
+        try:
+            return await loop.run_in_executor(executor, scan_item, item)
+
+        except ClientError as client_error:
+            if not is_throttle(client_error):
+                raise
+
+            throttled = True
+            attempts += call_attempts(client_error)
+            if attempts >= MAX_ATTEMPTS:
+                if on_exhausted is None:
+                    raise
+                return await loop.run_in_executor(executor, on_exhausted, item, client_error)
+
+        finally:
+            limiter.release(started, throttled)
+
+        await asyncio.sleep(backoff_delay(attempts))
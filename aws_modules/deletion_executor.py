@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_modules.aws_session import REGION, get_client
+from aws_modules.concurrency import MAX_ATTEMPTS, AdaptiveLimiter, TokenBucket, backoff_delay, call_attempts, is_throttle
+
+from botocore.exceptions import BotoCoreError, ClientError
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+# EC2 throttles mutating actions per account with a token bucket of
+# 200 requests refilled at 5 per second
+MUTATION_RATE = 5
+MUTATION_BURST = 200
+
+# plan kind -> (EC2 API call, ID parameter)
+DELETE_ACTIONS = {
+    'image': ('deregister_image', 'ImageId'),
+    'snapshot': ('delete_snapshot', 'SnapshotId'),
+    'volume': ('delete_volume', 'VolumeId'),
+}
+
+
+# deletes EC2 resources on a worker pool behind a shared rate limiter, with
+# the number in flight cut back when EC2 throttles; each item gets its own
+# outcome, so one failure doesn't stop the rest
+class DeletionExecutor:
+    def __init__(self, region=REGION, workers=8, mutation_rate=MUTATION_RATE, mutation_burst=MUTATION_BURST, dry_run=False):
+        self.region = region
+        self.workers = workers
+        self.dry_run = dry_run
+        self.rate_limiter = TokenBucket(mutation_rate, mutation_burst) if mutation_rate else None
+        self.concurrency = AdaptiveLimiter(workers)
+        self.outcomes = []
+        self._lock = threading.Lock()
+
+    def delete(self, kind, resource_id):
+        api_call, id_param = DELETE_ACTIONS[kind]
+        ec2_client = get_client('ec2', self.region)
+        outcome = {'kind': kind, 'id': resource_id, 'status': 'deleted', 'attempts': 0}
+
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            started = self.concurrency.acquire()
+            throttled = False
+            outcome['attempts'] += 1
+
+            try:
+                getattr(ec2_client, api_call)(**{id_param: resource_id, 'DryRun': self.dry_run})
+                break
+
+            except ClientError as api_err:
+                error_code = api_err.response['Error']['Code']
+                throttled = is_throttle(api_err)
+                # botocore's own retries count toward the item's attempts
+                outcome['attempts'] += call_attempts(api_err) - 1
+
+                if error_code == 'DryRunOperation':
+                    outcome['status'] = 'dry-run'
+                    break
+
+                if not throttled or outcome['attempts'] >= MAX_ATTEMPTS:
+                    error_message = api_err.response['Error']['Message']
+                    LOGGER.error(f"AWS API Error: {error_code} - {error_message} for {resource_id}")
+                    outcome.update({'status': 'failed', 'error': error_code})
+                    break
+
+            # connection errors and timeouts, already retried by botocore
+            except BotoCoreError as botocore_err:
+                LOGGER.error(f"BotoCoreError: {botocore_err} for {resource_id}")
+                outcome.update({'status': 'failed', 'error': type(botocore_err).__name__})
+                break
+
+            finally:
+                self.concurrency.release(started, throttled)
+
+            # throttled: requeued behind a backoff, at a lower limit
+            time.sleep(backoff_delay(outcome['attempts']))
+
+        with self._lock:
+            self.outcomes.append(outcome)
+
+        return outcome
+
+    # resource_ids may be a generator, at most twice the worker count are queued
+    def run(self, kind, resource_ids):
+        in_flight = threading.BoundedSemaphore(self.workers * 2)
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for resource_id in resource_ids:
+                in_flight.acquire()
+                future = pool.submit(self.delete, kind, resource_id)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+
+        return [future.result() for future in futures]
+
+    def succeeded(self, outcomes):
+        return [outcome['id'] for outcome in outcomes if outcome['status'] != 'failed']
+
+    # {kind: {status: count}}
+    def summary(self):
+        summary = {}
+
+        with self._lock:
+            for outcome in self.outcomes:
+                statuses = summary.setdefault(outcome['kind'], Counter())
+                statuses[outcome['status']] += 1
+
+        return {kind: dict(statuses) for kind, statuses in summary.items()}
+
+    def failures(self):
+        with self._lock:
+            return [outcome for outcome in self.outcomes if outcome['status'] == 'failed']
@@ -0,0 +1,81 @@
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+FLUSH_LINES = 100
+FLUSH_SECONDS = 1.0
+
+
+# writes one JSON line per finding as it is produced; lines are buffered
+# and flushed every FLUSH_LINES lines or FLUSH_SECONDS, whichever is first,
+# a flusher thread covering quiet stretches with no new findings, and
+# close() ends the stream with a summary record
+class JsonlSink:
+    def __init__(self, stream=sys.stdout, flush_lines=FLUSH_LINES, flush_seconds=FLUSH_SECONDS, **context):
+        self.stream = stream
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.context = context
+        self.started = datetime.now(tz=timezone.utc)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_seconds):
+            with self._lock:
+                if self._buffer and time.monotonic() - self._last_flush >= self.flush_seconds:
+                    self._flush()
+
+    def write(self, record):
+        line = json.dumps({**self.context, **record}, separators=(',', ':'), default=str)
+
+        with self._lock:
+            self._buffer.append(line + '\n')
+
+            if len(self._buffer) >= self.flush_lines or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def finding(self, item, cis_id, msg):
+        self.write({'type': 'finding', 'item': item, 'cis_id': cis_id, 'message': msg})
+
+    def exception(self, item, msg):
+        self.write({'type': 'exception', 'item': item, 'message': msg})
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self.stream.write(''.join(self._buffer))
+            self._buffer.clear()
+
+        self.stream.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self, issues=None, error=None):
+        summary = {
+            'type': 'summary',
+            'started': self.started.isoformat(),
+            'finished': datetime.now(tz=timezone.utc).isoformat(),
+            'complete': error is None,
+        }
+
+        if issues is not None:
+            summary['findings'] = issues.count()
+            summary['by_cis'] = issues.count_by_cis()
+            summary['exceptions'] = issues.exception_count()
+
+        if error is not None:
+            summary['error'] = str(error)
+
+        self.write(summary)
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from aws_modules.aws_cloudtrails import check_cloudtrail, check_cloudwatch_is_logging, get_trail_buckets
+from aws_modules.aws_s3 import (BUCKET_CHECK_FIELDS, check_bucket_encryption, check_bucket_policy,
+                                check_bucket_public_access, check_bucket_versioning, get_bucket_region,
+                                get_bucket_snapshot, snapshot_error_code)
+from aws_modules.aws_session import REGION, get_account, get_buckets, get_client, get_trails, run_scoped
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.concurrency import get_limiter, scan_adaptive
+
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+# re-audit only what changed since the last run: the state file keeps every
+# resource's fingerprint and findings, and CloudTrail management events since
+# the checkpoint name the buckets and trails to check again
+#   python main.py --incremental ~/.cache/cis_checks/state.json
+STATE_VERSION = 1
+# events show up in lookup_events up to ~15 minutes after they happen
+EVENT_DELAY = timedelta(minutes=15)
+# lookup_events only reaches back 90 days, older checkpoints need a full scan
+EVENT_RETENTION = timedelta(days=90)
+
+BUCKET_EVENTS = (
+    'CreateBucket',
+    'DeleteBucket',
+    'PutBucketAcl',
+    'PutBucketPolicy',
+    'DeleteBucketPolicy',
+    'PutBucketEncryption',
+    'DeleteBucketEncryption',
+    'PutBucketVersioning',
+    'PutBucketPublicAccessBlock',
+    'DeleteBucketPublicAccessBlock',
+    'PutBucketLogging',
+)
+TRAIL_EVENTS = (
+    'CreateTrail',
+    'UpdateTrail',
+    'DeleteTrail',
+    'StartLogging',
+    'StopLogging',
+    'PutEventSelectors',
+)
+
+
+def fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# what the bucket checks read, failed lookups included
+def bucket_fingerprint(bucket_name, region=REGION):
+    snapshot = get_bucket_snapshot(bucket_name, BUCKET_CHECK_FIELDS, region)
+
+    return fingerprint({
+        field: snapshot_error_code(snapshot, field) or getattr(snapshot, field)
+        for field in BUCKET_CHECK_FIELDS
+    })
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as state_file:
+        state = json.load(state_file)
+
+    if state.get('version') != STATE_VERSION:
+        LOGGER.warning(f'{path} is not a version {STATE_VERSION} state file, scanning everything')
+        return None
+
+    return state
+
+
+# written aside and renamed, so an interrupted run leaves the last good state
+def save_state(state, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.tmp'
+
+    with open(temp_path, 'w') as state_file:
+        json.dump(state, state_file, separators=(',', ':'))
+
+    os.replace(temp_path, path)
+
+
+# aws cloudtrail lookup-events --lookup-attributes AttributeKey=EventName,AttributeValue=<event_name> --start-time <since>
+def get_event_resources(event_name, since, region=REGION):
+    paginator = get_client('cloudtrail', region).get_paginator('lookup_events')
+    pages = paginator.paginate(
+        LookupAttributes=[{'AttributeKey': 'EventName', 'AttributeValue': event_name}],
+        StartTime=since)
+
+    return {
+        resource['ResourceName']
+        for resource in pages.search('Events[].Resources[]')
+        if resource and 'ResourceName' in resource
+    }
+
+
+# event name -> names of the resources it touched since the checkpoint;
+# lookup_events takes one attribute per call and allows 2 calls per second
+# per region, so each region's lookups run one at a time
+def get_changed_resources(since, event_names, region=REGION):
+    resources = scan_adaptive(
+        lambda event_name: get_event_resources(event_name, since, region),
+        event_names, get_limiter('cloudtrail_events', region, 1))
+
+    return dict(zip(event_names, resources))
+
+
+# bucket events are recorded in the bucket's own region, trail events in the audit region
+def get_all_changed_resources(since, bucket_regions, region=REGION):
+    changed = get_changed_resources(since, BUCKET_EVENTS + TRAIL_EVENTS, region)
+
+    for bucket_region in sorted(set(bucket_regions) - {region}):
+        for event_name, resources in get_changed_resources(since, BUCKET_EVENTS, bucket_region).items():
+            changed[event_name] |= resources
+
+    return changed
+
+
+def previous_state(state, account, region, started):
+    if state is None:
+        return None
+
+    if (state['account'], state['region']) != (account, region):
+        LOGGER.warning(f"state is for {state['account']} in {state['region']}, scanning everything")
+        return None
+
+    if started - datetime.fromisoformat(state['checkpoint']) > EVENT_RETENTION:
+        LOGGER.warning(f"checkpoint {state['checkpoint']} is older than CloudTrail event history, scanning everything")
+        return None
+
+    return state
+
+
+# items whose check was cut short by throttling, see log_throttled
+def throttled_items(exceptions):
+    return {item for item, msg in exceptions.items() if msg.startswith('Throttled')}
+
+
+# carries a section's findings and exceptions over for the items kept
+def carry_over(section, issues, keep):
+    for item, cis_id, index in section['findings']:
+        if keep(item, cis_id):
+            issues.add(item, cis_id, index)
+
+    for item, msg in section['exceptions'].items():
+        if keep(item, None):
+            issues.add_exception(item, msg)
+
+
+@run_scoped
+def incremental_audit(state_path, workers=1, region=REGION):
+    started = datetime.now(tz=timezone.utc)
+    account = get_account()
+    state = previous_state(load_state(state_path), account, region, started)
+
+    bucket_list = get_buckets()
+    buckets = {bucket['Name']: str(bucket.get('CreationDate')) for bucket in bucket_list}
+    trails = get_trails(region)
+    trail_fingerprints = {trail['Name']: fingerprint(trail) for trail in trails}
+
+    if state is None:
+        rescan_buckets = set(buckets)
+        rescan_trails = True
+        previous_buckets = {}
+
+    else:
+        since = datetime.fromisoformat(state['checkpoint']) - EVENT_DELAY
+        previous_buckets = state['buckets']
+        # new buckets are checked anyway, only known buckets' regions matter
+        bucket_regions = {entry['region'] for entry in previous_buckets.values()}
+        changed = get_all_changed_resources(since, bucket_regions, region)
+
+        # new, recreated, changed, or failed to check last time
+        rescan_buckets = {
+            bucket_name for bucket_name, created in buckets.items()
+            if previous_buckets.get(bucket_name, {}).get('created') != created
+        }
+        rescan_buckets.update(*(changed[event_name] for event_name in BUCKET_EVENTS))
+        rescan_buckets.update(throttled_items(state['s3']['exceptions']))
+        rescan_buckets.intersection_update(buckets)
+
+        rescan_trails = (
+            trail_fingerprints != state['trails']
+            or any(changed[event_name] for event_name in TRAIL_EVENTS)
+            or not changed['PutBucketLogging'].isdisjoint(get_trail_buckets(trails))
+            or bool(throttled_items(state['cloudtrail']['exceptions']))
+        )
+
+    bucket_issues = IssueStore()
+    trail_issues = IssueStore()
+
+    if state is not None:
+        # deleted buckets drop out, unchanged ones keep their findings
+        carry_over(state['s3'], bucket_issues, lambda item, cis_id: item in buckets and item not in rescan_buckets)
+
+        # 3.4 depends on the clock and is always checked again
+        if not rescan_trails:
+            carry_over(state['cloudtrail'], trail_issues, lambda item, cis_id: cis_id not in (None, '3.4'))
+
+    if rescan_buckets:
+        bucket_names = sorted(rescan_buckets)
+        check_bucket_encryption(bucket_issues, workers, None, bucket_names)
+        check_bucket_policy(bucket_issues, workers, None, bucket_names)
+        check_bucket_public_access(bucket_issues, workers, None, bucket_names)
+        check_bucket_versioning(bucket_issues, workers, None, bucket_names)
+
+    if rescan_trails:
+        check_cloudtrail(trail_issues, region, workers)
+    check_cloudwatch_is_logging(trail_issues, region, workers)
+
+    rescanned = [bucket for bucket in bucket_list if bucket['Name'] in rescan_buckets]
+    rescanned_regions = scan_adaptive(get_bucket_region, rescanned, get_limiter('s3', None, workers))
+    bucket_state = {
+        bucket_name: entry for bucket_name, entry in previous_buckets.items()
+        if bucket_name in buckets and bucket_name not in rescan_buckets
+    }
+    throttled_buckets = throttled_items(bucket_issues.exceptions())
+    reconfigured = 0
+
+    for bucket, bucket_region in zip(rescanned, rescanned_regions):
+        bucket_name = bucket['Name']
+        # throttled buckets were never read, they are checked again next run
+        bucket_fingerprint_now = None if bucket_name in throttled_buckets else bucket_fingerprint(bucket_name, region)
+        reconfigured += previous_buckets.get(bucket_name, {}).get('fingerprint') != bucket_fingerprint_now
+        bucket_state[bucket_name] = {
+            'created': buckets[bucket_name],
+            'region': bucket_region,
+            'fingerprint': bucket_fingerprint_now,
+        }
+
+    save_state({
+        'version': STATE_VERSION,
+        'account': account,
+        'region': region,
+        'checkpoint': started.isoformat(),
+        'buckets': bucket_state,
+        'trails': trail_fingerprints,
+        's3': {'findings': bucket_issues.findings(), 'exceptions': bucket_issues.exceptions()},
+        'cloudtrail': {'findings': trail_issues.findings(), 'exceptions': trail_issues.exceptions()},
+    }, state_path)
+
+    LOGGER.info(
+        f'{len(rescan_buckets)} of {len(buckets)} buckets checked again ({reconfigured} reconfigured), '
+        f'trails {"checked again" if rescan_trails else "unchanged"}')
+
+    return bucket_issues, trail_issues
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+import logging
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'cis_checks', 'responses.sqlite')
+MAX_ENTRIES = 100000
+
+# seconds a cached response stays fresh, per operation
+DEFAULT_TTL = 3600
+OPERATION_TTL = {
+    'list_buckets': 3600,
+    'get_bucket_location': 2592000,
+    'get_bucket_versioning': 86400,
+    'get_bucket_encryption': 86400,
+    'get_bucket_policy': 86400,
+    'get_public_access_block': 86400,
+    'get_bucket_acl': 86400,
+    'get_bucket_logging': 86400,
+    'describe_trails': 86400,
+    'get_trail_status': 900,
+    'get_event_selectors': 86400,
+    'get_ebs_encryption_by_default': 86400,
+    'describe_key': 86400,
+    'get_key_rotation_status': 3600,
+}
+
+# "not configured" answers are as stable as the configs themselves
+CACHEABLE_ERRORS = {
+    'NoSuchBucketPolicy',
+    'NoSuchPublicAccessBlockConfiguration',
+    'ServerSideEncryptionConfigurationNotFoundError',
+    'TrailNotFoundException',
+}
+
+_CACHE = None
+
+
+def encode_response(response):
+    def encode(value):
+        if isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+    return json.dumps(response, default=encode, separators=(',', ':'))
+
+
+def decode_response(body):
+    def decode(obj):
+        if '__datetime__' in obj:
+            return datetime.fromisoformat(obj['__datetime__'])
+        return obj
+
+    return json.loads(body, object_hook=decode)
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_age=None, max_entries=MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # other processes may share the file, wait for their writes
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, operation TEXT, created REAL, accessed REAL, body TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._count = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def ttl(self, operation):
+        ttl = OPERATION_TTL.get(operation, DEFAULT_TTL)
+
+        if self.max_age is not None:
+            ttl = min(ttl, self.max_age)
+        return ttl
+
+    def get(self, key, operation):
+        ttl = self.ttl(operation)
+        if ttl <= 0:
+            return None
+
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body FROM responses WHERE key = ? AND created >= ?',
+                (key, now - ttl)).fetchone()
+
+            if row is None:
+                return None
+
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+
+        return decode_response(row[0])
+
+    def put(self, key, operation, response):
+        now = time.time()
+        body = encode_response(response)
+
+        with self._lock:
+            # refreshing a key keeps the row count, only new keys add to it
+            cursor = self._db.execute(
+                'UPDATE responses SET operation = ?, created = ?, accessed = ?, body = ? WHERE key = ?',
+                (operation, now, now, body, key))
+
+            if cursor.rowcount == 0:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                    (key, operation, now, now, body))
+                self._count += 1
+
+            # other processes write to the same file, recount before evicting
+            if self._count > self.max_entries:
+                self._count = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+            # evict least recently used entries down to 90% of the bound
+            if self._count > self.max_entries:
+                excess = self._count - int(self.max_entries * 0.9)
+                self._db.execute(
+                    'DELETE FROM responses WHERE key IN '
+                    '(SELECT key FROM responses ORDER BY accessed LIMIT ?)', (excess,))
+                self._count = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def configure_cache(path=CACHE_PATH, max_age=None, max_entries=MAX_ENTRIES):
+    global _CACHE
+
+    if _CACHE is not None:
+        _CACHE.close()
+
+    _CACHE = ResponseCache(path, max_age, max_entries)
+    return _CACHE
+
+
+def get_cache():
+    return _CACHE
+
+
+def disable_cache():
+    global _CACHE
+
+    if _CACHE is not None:
+        _CACHE.close()
+    _CACHE = None
+
+
+def cache_key(account, region, operation, params):
+    key = json.dumps([account, region, operation, params], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# read-through call: served from the cache within the operation TTL,
+# otherwise made live and stored
+def cached_call(account, client, operation, **params):
+    if _CACHE is None:
+        return getattr(client, operation)(**params)
+
+    key = cache_key(account, client.meta.region_name, operation, params)
+    cached = _CACHE.get(key, operation)
+
+    if cached is not None:
+        if '__error__' in cached:
+            error_response = cached['__error__']
+            error_class = client.exceptions.from_code(error_response['Error']['Code'])
+            raise error_class(error_response, client.meta.method_to_api_mapping.get(operation, operation))
+        return cached
+
+    try:
+        response = getattr(client, operation)(**params)
+
+    except ClientError as client_error:
+        if client_error.response['Error']['Code'] in CACHEABLE_ERRORS:
+            _CACHE.put(key, operation, {'__error__': {'Error': client_error.response['Error']}})
+        raise
+
+    response.pop('ResponseMetadata', None)
+    _CACHE.put(key, operation, response)
+    return response
@@ -0,0 +1,89 @@
+import functools
+import json
+
+# bucket policies and ACLs reduced once to what the CIS checks ask of them;
+# buckets sharing a policy template share one verdict
+ALL_USERS = 'http://acs.amazonaws.com/groups/global/AllUsers'
+AUTHENTICATED_USERS = 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers'
+# condition operators and keys are case-insensitive
+SECURE_TRANSPORT_OPERATORS = ('bool', 'boolifexists')
+SECURE_TRANSPORT_KEY = 'aws:securetransport'
+# distinct policy texts whose verdicts are kept
+POLICY_VERDICTS = 1024
+
+
+class PolicyVerdict:
+    __slots__ = ('enforces_ssl', 'allows_anonymous')
+
+    def __init__(self, enforces_ssl, allows_anonymous):
+        self.enforces_ssl = enforces_ssl
+        self.allows_anonymous = allows_anonymous
+
+    def __repr__(self):
+        return f'PolicyVerdict(enforces_ssl={self.enforces_ssl}, allows_anonymous={self.allows_anonymous})'
+
+
+class AclVerdict:
+    __slots__ = ('all_users', 'authenticated_users')
+
+    def __init__(self, all_users, authenticated_users):
+        self.all_users = all_users
+        self.authenticated_users = authenticated_users
+
+    def __repr__(self):
+        return f'AclVerdict(all_users={self.all_users}, authenticated_users={self.authenticated_users})'
+
+
+# policy fields may hold a single value or a list of them
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+# "*", {"AWS": "*"} or either with "*" in a list
+def is_anonymous(principal):
+    if isinstance(principal, dict):
+        principal = principal.get('AWS')
+
+    return '*' in as_list(principal)
+
+
+# Deny with {"Bool": {"aws:SecureTransport": "false"}}, BoolIfExists included
+def denies_insecure_transport(statement):
+    if statement.get('Effect') != 'Deny':
+        return False
+
+    for operator, conditions in statement.get('Condition', {}).items():
+        if operator.lower() not in SECURE_TRANSPORT_OPERATORS:
+            continue
+
+        for key, values in conditions.items():
+            if key.lower() == SECURE_TRANSPORT_KEY and any(str(value).lower() == 'false' for value in as_list(values)):
+                return True
+
+    return False
+
+
+# one pass over the statements answers both 2.1.2 and 2.1.5
+def compile_policy(policy_text):
+    enforces_ssl = False
+    allows_anonymous = False
+
+    for statement in as_list(json.loads(policy_text).get('Statement', [])):
+        enforces_ssl = enforces_ssl or denies_insecure_transport(statement)
+        allows_anonymous = allows_anonymous or (
+            statement.get('Effect') == 'Allow' and is_anonymous(statement.get('Principal')))
+
+    return PolicyVerdict(enforces_ssl, allows_anonymous)
+
+
+# a verdict depends on the policy text alone, so it outlives the run; the
+# cache is bounded, as policies naming their own bucket are rarely shared
+@functools.lru_cache(maxsize=POLICY_VERDICTS)
+def get_policy_verdict(policy_text):
+    return compile_policy(policy_text)
+
+
+# aws s3api get-bucket-acl --bucket <bucket_name> --query 'Grants[*].Grantee.URI'
+def compile_acl(grants):
+    uris = {grant.get('Grantee', {}).get('URI') for grant in grants}
+    return AclVerdict(ALL_USERS in uris, AUTHENTICATED_USERS in uris)
@@ -1,22 +1,132 @@
-from my_modules.benchmarker import print_execution_time
+import argparse
+import sys
 
-from aws_modules.aws_s3 import check_bucket_encryption, check_bucket_policy, check_bucket_public_access, check_bucket_versioning
+from aws_modules.aws_s3 import check_bucket_suite
+from aws_modules.api_metrics import add_metrics_args, report_metrics, start_metrics
+from aws_modules.aws_accounts import check_accounts
 from aws_modules.aws_cloudtrails import check_cloudtrail, check_cloudwatch_is_logging
+from aws_modules.aws_cmk import check_cmk_rotation, check_trail_encryption
+from aws_modules.aws_ec2_rds import check_ebs_encryption, check_rds_encryption
+from aws_modules.aws_regions import check_all_regions
+from aws_modules.aws_session import configure_clients, get_account, run_scoped
+from aws_modules.cassette import add_cassette_args, start_recording, start_replay
+from aws_modules.cis_error_logger import IssueStore
+from aws_modules.findings_sink import JsonlSink
+from aws_modules.incremental import incremental_audit
+from aws_modules.response_cache import configure_cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='CIS benchmark checks')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of buckets, trails and keys checked in parallel')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse AWS responses cached by earlier runs, up to a day old for most configs')
+    parser.add_argument('--max-age', type=int, default=None,
+                        help='reuse cached AWS responses at most this many seconds old (implies --cache)')
+    parser.add_argument('--all-regions', action='store_true',
+                        help='run every check in all enabled regions')
+    parser.add_argument('--regions', nargs='+', default=None,
+                        help='regions to check with --all-regions (default: all enabled)')
+    parser.add_argument('--jsonl', default=None, metavar='PATH',
+                        help="stream findings as JSON lines to PATH ('-' for stdout)")
+    parser.add_argument('--role-arns', nargs='+', default=None,
+                        help='assume each role and run the CIS suite in that account')
+    parser.add_argument('--account-workers', type=int, default=4,
+                        help='number of accounts checked in parallel processes')
+    parser.add_argument('--incremental', default=None, metavar='STATE',
+                        help='only check buckets and trails changed since the run that wrote STATE')
+    # cassettes cover the shared session, not the per-account processes
+    add_cassette_args(parser)
+    add_metrics_args(parser)
+    return parser.parse_args()
+
+
+# full S3, CloudTrail, KMS, EBS and RDS suite with findings streamed out as they are found
+@run_scoped
+def stream_checks(path, workers=1):
+    stream = sys.stdout if path == '-' else open(path, 'a')
+    sink = JsonlSink(stream, account=get_account())
+    issues = IssueStore(sink=sink, retain=False)
+
+    try:
+        check_bucket_suite(issues, workers)
+        check_cloudtrail(issues, workers=workers)
+        check_cloudwatch_is_logging(issues, workers=workers)
+        check_trail_encryption(issues, workers=workers)
+        check_cmk_rotation(issues, workers=workers)
+        check_ebs_encryption(issues)
+        check_rds_encryption(issues)
+
+    except Exception as err:
+        sink.close(issues, err)
+        raise
+
+    else:
+        sink.close(issues)
+
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
 
 
 def main():
-    # no_of_runs = 2
-    # print_execution_time(check_bucket_encryption.__name__, no_of_runs)
-
-    # bucket_issues = check_bucket_encryption()
-    # bucket_issues = check_bucket_policy(bucket_issues)
-    # bucket_issues = check_bucket_public_access(bucket_issues)
-    # bucket_issues = check_bucket_versioning()
-    # print(bucket_issues)
-
-    # trails = check_cloudtrail()
-    trail_issues = check_cloudwatch_is_logging()
-    print(trail_issues)
+    args = parse_args()
+    configure_clients(args.workers)
+
+    # the cache is opt-in, reports are otherwise built from live answers only;
+    # cached answers would never reach the cassette, so it stays off for both;
+    # incremental runs check changed resources, which must not come from the cache
+    if args.replay:
+        start_replay(args.replay, args.replay_latency)
+    elif args.record:
+        cassette = start_recording()
+    elif not args.incremental and (args.cache or args.max_age is not None):
+        configure_cache(max_age=args.max_age)
+
+    metrics = start_metrics() if args.metrics or args.metrics_file else None
+
+    try:
+        run_checks(args)
+
+    finally:
+        if args.record and not args.replay:
+            cassette.save(args.record)
+        if metrics is not None:
+            report_metrics(metrics, args.metrics_file)
+
+
+@run_scoped
+def run_checks(args):
+    if args.incremental:
+        bucket_issues, trail_issues = incremental_audit(args.incremental, args.workers)
+        print({'s3': bucket_issues.to_dict(), 'cloudtrail': trail_issues.to_dict()})
+        return
+
+    if args.jsonl:
+        stream_checks(args.jsonl, args.workers)
+        return
+
+    if args.role_arns:
+        print(check_accounts(args.role_arns, args.account_workers, args.all_regions, args.regions, args.workers))
+        return
+
+    if args.all_regions:
+        print(check_all_regions(args.regions, bucket_workers=args.workers))
+        return
+
+    # benchmarks run offline against synthetic accounts:
+    # python -m my_modules.benchmarker --checks check_bucket_encryption --sizes 10 1000
+
+    # bucket_issues = check_bucket_encryption(workers=args.workers)
+    # bucket_issues = check_bucket_policy(bucket_issues, workers=args.workers)
+    # bucket_issues = check_bucket_public_access(bucket_issues, workers=args.workers)
+    # bucket_issues = check_bucket_versioning(workers=args.workers)
+    # print(bucket_issues.to_dict())
+
+    # trails = check_cloudtrail(workers=args.workers)
+    trail_issues = check_cloudwatch_is_logging(workers=args.workers)
+    print(trail_issues.to_dict())
 
 
 if __name__ == '__main__':
@@ -1,14 +1,463 @@
-import timeit
+import argparse
+import contextlib
+import io
+import json
+import logging
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 
+import boto3
 
-def print_execution_time(function_name, runs=1):
-    import_module_namespace = f'from __main__ import {function_name}'
+from aws_modules import aws_ami_cleaner, aws_cloudtrails, aws_cmk, aws_ec2_rds, aws_s3
+from aws_modules.aws_events import api_params, capture_params, error_response, make_response
+from aws_modules.aws_session import REGION, configure_clients, get_client, get_resource, set_session
+from aws_modules.response_cache import disable_cache
 
-    result = timeit.timeit(
-        stmt=f'{function_name}()',
-        setup=import_module_namespace,
-        # globals=globals()  # execution w/in current global namespace, not for imports
-        number=runs
-    )
+SIZES = (10, 1000, 10000, 100000)
+ACCOUNT = '123456789012'
+VERSIONS_PER_BUILD = 20
 
-    print(f'{function_name} ran {runs} time(s) in {result} seconds')
+# per-resource calls that can be throttled, with the code AWS answers with
+THROTTLED_CALLS = {
+    'GetBucketVersioning': 'SlowDown',
+    'GetBucketEncryption': 'SlowDown',
+    'GetBucketPolicy': 'SlowDown',
+    'GetPublicAccessBlock': 'SlowDown',
+    'GetBucketAcl': 'SlowDown',
+    'GetBucketLogging': 'SlowDown',
+    'GetTrailStatus': 'ThrottlingException',
+    'GetEventSelectors': 'ThrottlingException',
+    'DescribeKey': 'ThrottlingException',
+    'GetKeyRotationStatus': 'ThrottlingException',
+    'DeregisterImage': 'RequestLimitExceeded',
+    'DeleteSnapshot': 'RequestLimitExceeded',
+    'DeleteVolume': 'RequestLimitExceeded',
+}
+
+ALL_USERS = 'http://acs.amazonaws.com/groups/global/AllUsers'
+SSL_POLICY = json.dumps({'Statement': [
+    {'Effect': 'Deny', 'Principal': '*', 'Action': 's3:*',
+     'Condition': {'Bool': {'aws:SecureTransport': 'false'}}}]})
+OPEN_POLICY = json.dumps({'Statement': [
+    {'Effect': 'Allow', 'Principal': '*', 'Action': 's3:GetObject'}]})
+
+CHECKS = {
+    'check_bucket_versioning': lambda workers: aws_s3.check_bucket_versioning(None, workers),
+    'check_bucket_encryption': lambda workers: aws_s3.check_bucket_encryption(None, workers),
+    'check_bucket_policy': lambda workers: aws_s3.check_bucket_policy(None, workers),
+    'check_bucket_public_access': lambda workers: aws_s3.check_bucket_public_access(None, workers),
+    'check_cloudtrail': lambda workers: aws_cloudtrails.check_cloudtrail(None, REGION, workers),
+    'check_cloudwatch_is_logging': lambda workers: aws_cloudtrails.check_cloudwatch_is_logging(None, REGION, workers),
+    'check_cmk_rotation': lambda workers: aws_cmk.check_cmk_rotation(None, REGION, workers),
+    'check_trail_encryption': lambda workers: aws_cmk.check_trail_encryption(None, REGION, workers),
+    'check_rds_encryption': lambda workers: aws_ec2_rds.check_rds_encryption(None, REGION),
+    # deletions are stubbed, so EC2's mutation rate limit is left off
+    'aws_ami_cleaner': lambda workers: aws_ami_cleaner.main(workers=max(workers, 8), mutation_rate=None),
+}
+
+
+# synthetic account of size resources per inventory, answered from memory
+# through the session's before-call event with latency seconds per call;
+# a throttle fraction of per-resource calls is answered with a throttling error
+class SyntheticAccount:
+    def __init__(self, size, latency=0.0, throttle=0.0):
+        self.size = size
+        self.latency = latency
+        self.throttle = throttle
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._random = random.Random(size)
+        self._lock = threading.Lock()
+        self._handlers = {
+            'GetCallerIdentity': lambda params: {'Account': ACCOUNT},
+            'ListBuckets': self.list_buckets,
+            'GetBucketLocation': lambda params: {'LocationConstraint': REGION},
+            'GetBucketVersioning': self.get_bucket_versioning,
+            'GetBucketEncryption': self.get_bucket_encryption,
+            'GetBucketPolicy': self.get_bucket_policy,
+            'GetPublicAccessBlock': self.get_public_access_block,
+            'GetBucketAcl': self.get_bucket_acl,
+            'GetBucketLogging': self.get_bucket_logging,
+            'DescribeTrails': self.describe_trails,
+            'GetTrailStatus': self.get_trail_status,
+            'GetEventSelectors': self.get_event_selectors,
+            'ListKeys': self.list_keys,
+            'DescribeKey': self.describe_key,
+            'GetKeyRotationStatus': self.get_key_rotation_status,
+            'DescribeImages': self.describe_images,
+            'DescribeInstances': self.describe_instances,
+            'DescribeLaunchTemplateVersions': self.describe_launch_template_versions,
+            'DescribeLaunchConfigurations': self.describe_launch_configurations,
+            'DescribeAutoScalingGroups': self.describe_auto_scaling_groups,
+            'DescribeFleets': lambda params: {'Fleets': []},
+            'DescribeSpotFleetRequests': lambda params: {'SpotFleetRequestConfigs': []},
+            'DescribeSnapshots': self.describe_snapshots,
+            'DescribeVolumes': self.describe_volumes,
+            'DescribeDBInstances': self.describe_db_instances,
+            'DescribeDBClusters': self.describe_db_clusters,
+            'DeregisterImage': lambda params: {},
+            'DeleteSnapshot': lambda params: {},
+            'DeleteVolume': lambda params: {},
+        }
+
+    def session(self):
+        session = boto3.session.Session(
+            aws_access_key_id='benchmark',
+            aws_secret_access_key='benchmark',
+            region_name=REGION)
+        session.events.register('before-parameter-build.*.*', capture_params)
+        session.events.register('before-call.*.*', self.respond)
+        return session
+
+    def respond(self, model, context, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+            throttled = model.name in THROTTLED_CALLS and self._random.random() < self.throttle
+            if throttled:
+                self.throttled[model.name] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if throttled:
+            return error_response(THROTTLED_CALLS[model.name], 'Rate exceeded', 503)
+
+        response = self._handlers[model.name](api_params(context))
+
+        if isinstance(response, str):
+            return error_response(response)
+        return make_response(response)
+
+    # resource numbers are encoded in their names: b-00042, trail-00042, ...
+    @staticmethod
+    def index(name):
+        return int(name.rsplit('-', 1)[-1])
+
+    # like S3, BucketRegion and ContinuationToken only come back when paged with MaxBuckets
+    def list_buckets(self, params):
+        if 'MaxBuckets' not in params:
+            return {'Buckets': [{'Name': f'b-{i:06d}'} for i in range(self.size)]}
+
+        start = int(params.get('ContinuationToken', 0))
+        end = min(self.size, start + params['MaxBuckets'])
+        response = {'Buckets': [{'Name': f'b-{i:06d}', 'BucketRegion': REGION} for i in range(start, end)]}
+
+        if end < self.size:
+            response['ContinuationToken'] = str(end)
+        return response
+
+    def get_bucket_versioning(self, params):
+        return {'Status': 'Enabled'} if self.index(params['Bucket']) % 2 else {}
+
+    def get_bucket_encryption(self, params):
+        if self.index(params['Bucket']) % 3 == 0:
+            return 'ServerSideEncryptionConfigurationNotFoundError'
+        return {'ServerSideEncryptionConfiguration': {'Rules': [
+            {'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'AES256'}}]}}
+
+    def get_bucket_policy(self, params):
+        i = self.index(params['Bucket'])
+        if i % 4 == 0:
+            return 'NoSuchBucketPolicy'
+        return {'Policy': SSL_POLICY if i % 4 == 1 else OPEN_POLICY}
+
+    def get_public_access_block(self, params):
+        if self.index(params['Bucket']) % 5:
+            return 'NoSuchPublicAccessBlockConfiguration'
+        return {'PublicAccessBlockConfiguration': {
+            'BlockPublicAcls': True, 'IgnorePublicAcls': True,
+            'BlockPublicPolicy': True, 'RestrictPublicBuckets': True}}
+
+    def get_bucket_acl(self, params):
+        grants = [{'Grantee': {'Type': 'CanonicalUser', 'ID': 'owner'}, 'Permission': 'FULL_CONTROL'}]
+        if self.index(params['Bucket']) % 7 == 0:
+            grants.append({'Grantee': {'Type': 'Group', 'URI': ALL_USERS}, 'Permission': 'READ'})
+        return {'Grants': grants}
+
+    def get_bucket_logging(self, params):
+        if self.index(params['Bucket']) % 2:
+            return {}
+        return {'LoggingEnabled': {'TargetBucket': params['Bucket'], 'TargetPrefix': 'logs/'}}
+
+    def describe_trails(self, params):
+        return {'trailList': [{
+            'Name': f'trail-{i:06d}',
+            'TrailARN': f'arn:aws-us-gov:cloudtrail:{REGION}:{ACCOUNT}:trail/trail-{i:06d}',
+            'HomeRegion': REGION,
+            'S3BucketName': f'b-{i % 10:06d}',
+            'IsMultiRegionTrail': i % 10 == 0,
+            'LogFileValidationEnabled': i % 3 != 0,
+            'CloudWatchLogsLogGroupArn': f'arn:aws:logs:{REGION}:{ACCOUNT}:log-group:trail-{i}',
+            **({'KmsKeyId': self.key_arn(i)} if i % 4 else {}),
+        } for i in range(self.size)]}
+
+    def get_trail_status(self, params):
+        delivered = datetime.now(tz=timezone.utc) - timedelta(hours=self.index(params['Name']) % 48)
+        return {'IsLogging': True, 'LatestCloudWatchLogsDeliveryTime': delivered}
+
+    # every other multi-region trail only records write management events
+    def get_event_selectors(self, params):
+        return {'EventSelectors': [{
+            'ReadWriteType': 'WriteOnly' if self.index(params['TrailName']) % 20 == 0 else 'All',
+            'IncludeManagementEvents': True,
+            'DataResources': [],
+        }]}
+
+    def key_arn(self, i):
+        return f'arn:aws-us-gov:kms:{REGION}:{ACCOUNT}:key/key-{i:06d}'
+
+    # pages of up to Limit (100 by default) with a Marker, like KMS
+    def list_keys(self, params):
+        start = int(params.get('Marker', 0))
+        end = min(self.size, start + params.get('Limit', 100))
+        response = {
+            'Keys': [{'KeyId': f'key-{i:06d}', 'KeyArn': self.key_arn(i)} for i in range(start, end)],
+            'Truncated': end < self.size,
+        }
+
+        if end < self.size:
+            response['NextMarker'] = str(end)
+        return response
+
+    # every 5th key is AWS managed, every 7th disabled
+    def describe_key(self, params):
+        i = self.index(params['KeyId'])
+        return {'KeyMetadata': {
+            'KeyId': f'key-{i:06d}',
+            'Arn': self.key_arn(i),
+            'KeyManager': 'AWS' if i % 5 == 0 else 'CUSTOMER',
+            'KeyState': 'Disabled' if i % 7 == 0 else 'Enabled',
+            'Origin': 'AWS_KMS',
+            'KeySpec': 'SYMMETRIC_DEFAULT',
+        }}
+
+    def get_key_rotation_status(self, params):
+        return {'KeyRotationEnabled': self.index(params['KeyId']) % 4 != 0}
+
+    def image_id(self, i):
+        return f'ami-{i:017x}'
+
+    def describe_images(self, params):
+        builds = max(1, self.size // VERSIONS_PER_BUILD)
+        return {'Images': [{
+            'ImageId': self.image_id(i),
+            'Name': f'RHEL-7-build{i % builds:05d}-{20200101000000 + i}',
+            'State': 'available',
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': f'snap-{i:017x}'}}],
+        } for i in range(self.size)]}
+
+    # every 10th image backs an instance, honouring an image-id filter
+    def describe_instances(self, params):
+        image_ids = None
+        for instance_filter in params.get('Filters', []):
+            if instance_filter['Name'] == 'image-id':
+                image_ids = set(instance_filter['Values'])
+
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': f'i-{i:017x}', 'ImageId': self.image_id(i)}
+            for i in range(0, self.size, 10)
+            if image_ids is None or self.image_id(i) in image_ids]}]}
+
+    # $Latest/$Default of every template; a pinned version is an older image
+    def describe_launch_template_versions(self, params):
+        if 'LaunchTemplateId' in params:
+            i = int(params['LaunchTemplateId'].split('-')[1], 16)
+            return {'LaunchTemplateVersions': [
+                {'LaunchTemplateId': params['LaunchTemplateId'], 'VersionNumber': int(version),
+                 'LaunchTemplateData': {'ImageId': self.image_id(i + 1)}}
+                for version in params['Versions']]}
+
+        return {'LaunchTemplateVersions': [
+            {'LaunchTemplateId': f'lt-{i:017x}', 'LaunchTemplateData': {'ImageId': self.image_id(i)}}
+            for i in range(5, self.size, 100)]}
+
+    # every 200th template is pinned to version 1 by an Auto Scaling group
+    def describe_auto_scaling_groups(self, params):
+        return {'AutoScalingGroups': [
+            {'AutoScalingGroupName': f'asg-{i}',
+             'LaunchTemplate': {'LaunchTemplateId': f'lt-{i:017x}', 'Version': '1'}}
+            for i in range(5, self.size, 200)]}
+
+    def describe_launch_configurations(self, params):
+        return {'LaunchConfigurations': [
+            {'LaunchConfigurationName': f'lc-{i}', 'ImageId': self.image_id(i)}
+            for i in range(7, self.size, 100)]}
+
+    def describe_snapshots(self, params):
+        return {'Snapshots': [{
+            'SnapshotId': f'snap-{i:017x}',
+            'State': 'completed',
+            'Description': f'Created by CreateImage(i-{i:017x}) for {self.image_id(i)}',
+        } for i in range(self.size)]}
+
+    def volume_state(self, i):
+        return 'in-use' if i % 3 == 0 else 'available'
+
+    # pages with MaxResults/NextToken, honouring a status filter
+    def describe_volumes(self, params):
+        states = None
+        for volume_filter in params.get('Filters', []):
+            if volume_filter['Name'] == 'status':
+                states = set(volume_filter['Values'])
+
+        start = int(params.get('NextToken', 0))
+        end = min(self.size, start + params.get('MaxResults', self.size))
+        now = datetime.now(tz=timezone.utc)
+        response = {'Volumes': [{
+            'VolumeId': f'vol-{i:017x}',
+            'CreateTime': now - timedelta(days=i % 2000),
+            'State': self.volume_state(i),
+        } for i in range(start, end) if states is None or self.volume_state(i) in states]}
+
+        if end < self.size:
+            response['NextToken'] = str(end)
+        return response
+
+    # pages of up to MaxRecords (100 by default) with a Marker, like RDS
+    def describe_databases(self, params, key, arn_key, resource_type):
+        start = int(params.get('Marker', 0))
+        end = min(self.size, start + params.get('MaxRecords', 100))
+        response = {key: [{
+            arn_key: f'arn:aws-us-gov:rds:{REGION}:{ACCOUNT}:{resource_type}:db-{i:06d}',
+            'StorageEncrypted': i % 7 != 0,
+        } for i in range(start, end)]}
+
+        if end < self.size:
+            response['Marker'] = str(end)
+        return response
+
+    def describe_db_instances(self, params):
+        return self.describe_databases(params, 'DBInstances', 'DBInstanceArn', 'db')
+
+    def describe_db_clusters(self, params):
+        return self.describe_databases(params, 'DBClusters', 'DBClusterArn', 'cluster')
+
+
+def run_check(check_name, account, workers=1, trace_memory=False):
+    disable_cache()
+    set_session(account.session())
+    configure_clients(workers)
+
+    # client creation is a fixed cost, keep it out of the per-resource numbers
+    for service in ('sts', 's3', 'cloudtrail', 'ec2', 'autoscaling'):
+        get_client(service)
+    get_resource('ec2')
+    account.calls.clear()
+    account.throttled.clear()
+
+    # the checks log and print per resource, keep that out of the timing
+    logging.disable(logging.CRITICAL)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            CHECKS[check_name](workers)
+    finally:
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        logging.disable(logging.NOTSET)
+
+    return wall_time, peak_memory
+
+
+# timed without tracemalloc, which slows allocation-heavy code several-fold;
+# peak memory comes from a second, traced run
+def run_benchmark(check_name, size, latency=0.0, workers=1, trace_memory=True, throttle=0.0):
+    account = SyntheticAccount(size, latency, throttle)
+    wall_time, _ = run_check(check_name, account, workers)
+    calls = dict(account.calls)
+    api_calls = sum(calls.values())
+
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = run_check(check_name, SyntheticAccount(size), workers, trace_memory=True)
+
+    return {
+        'check': check_name,
+        'size': size,
+        'latency': latency,
+        'workers': workers,
+        'wall_time': round(wall_time, 6),
+        'api_calls': api_calls,
+        'calls_per_sec': round(api_calls / wall_time, 2) if wall_time else None,
+        'peak_memory': peak_memory,
+        'calls': calls,
+        'throttled': sum(account.throttled.values()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_header():
+    print(f"{'check':<30}{'size':>8}{'wall (s)':>12}{'calls':>10}{'calls/s':>12}{'peak MiB':>10}{'vs base':>10}")
+
+
+def print_result(result, baseline=None):
+    previous = {(r['check'], r['size']): r for r in (baseline or {}).get('results', [])}
+    base = previous.get((result['check'], result['size']))
+    change = f"{result['wall_time'] / base['wall_time']:.2f}x" if base and base['wall_time'] else '-'
+    peak = f"{result['peak_memory'] / 2**20:.1f}" if result['peak_memory'] is not None else '-'
+
+    print(f"{result['check']:<30}{result['size']:>8}{result['wall_time']:>12.3f}"
+          f"{result['api_calls']:>10}{result['calls_per_sec'] or 0:>12.0f}"
+          f"{peak:>10}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the CIS checks against synthetic accounts')
+    parser.add_argument('--checks', nargs='+', choices=sorted(CHECKS), default=sorted(CHECKS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SIZES))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds injected into every API call')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of per-resource calls answered with a throttling error')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the traced run that measures peak memory')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file the results are written to')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results JSON to compare wall times against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)
+
+    results = []
+    print_header()
+    for check_name in args.checks:
+        for size in args.sizes:
+            results.append(run_benchmark(
+                check_name, size, args.latency, args.workers, not args.no_memory, args.throttle))
+            print_result(results[-1], baseline)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'commit': git_commit(),
+            'created': datetime.now(tz=timezone.utc).isoformat(),
+            'results': results,
+        }, output_file, indent=2)
+
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()